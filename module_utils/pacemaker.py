@@ -0,0 +1,505 @@
+#   Copyright Red Hat, Inc. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+"""Code shared by the pacemaker modules.
+
+Ansible ships this file with each module using it, as
+ansible.module_utils.pacemaker.
+
+"""
+
+import cProfile
+import json
+import math
+import os
+import pstats
+import subprocess
+import tempfile
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+CACHE_DIR = '/run/ansible-pacemaker'
+
+
+class StatusCache(object):
+    """Host-local cache of cluster status shared between invocations.
+
+    Each key is stored in its own small json file, named with a
+    "pacemaker-" prefix, together with its creation time.  Files are replaced atomically with a rename, so
+    concurrent readers always see either the old or the new snapshot.
+    Any error is treated as a cache miss, the cache is never required.
+
+    """
+
+    prefix = 'pacemaker-'
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            "{0}{1}.json".format(self.prefix, key))
+
+    def get(self, key):
+        "Return the value stored for key if it is fresh enough, else None."
+        try:
+            with open(self._path(key)) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        age = time.time() - entry.get('time', 0)
+        if age < 0 or age >= self.ttl:
+            return None
+        return entry.get('value')
+
+    def put(self, key, value):
+        "Store value for key."
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0o700)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.directory, prefix='.{0}{1}.'.format(self.prefix, key))
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump({'time': time.time(), 'value': value}, tmp_file)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError):
+            pass
+
+    def fetch(self, key, read, trust=None):
+        """Return the value of key, from the cache if it is fresh enough.
+
+        Otherwise read() gives the value, which is cached unless empty.
+        A cached value is only used if trust(value) is true, so it never
+        hides the change the caller is waiting for.
+
+        """
+        if self.ttl > 0:
+            value = self.get(key)
+            if value is not None and (trust is None or trust(value)):
+                return value
+        value = read()
+        if self.ttl > 0 and value:
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Drop every snapshot, used once the cluster has been changed.
+
+        Only the files of the cache are removed, cache_dir may be shared.
+
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(self.prefix) and name.endswith('.json'):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+class Timeline(object):
+    """Per-probe record of a convergence wait.
+
+    Each probe stores when it ended (seconds since the wait started), how
+    long it took, and the expected and current values.  The arrays are
+    returned as is, with a summary, and can be appended to a json-lines
+    file to aggregate convergence latencies over many runs.
+
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.times = []
+        self.durations = []
+        self.expected = []
+        self.current = []
+
+    def probe(self, started, expected, current):
+        "Record a probe which began at `started`."
+        now = time.time()
+        self.times.append(round(now - self.start, 3))
+        self.durations.append(round(now - started, 3))
+        self.expected.append(expected)
+        self.current.append(current)
+
+    @staticmethod
+    def _percentile(values, percent):
+        "Nearest-rank percentile."
+        if not values:
+            return None
+        ordered = sorted(values)
+        rank = int(math.ceil(percent / 100.0 * len(ordered)))
+        return ordered[max(rank, 1) - 1]
+
+    def summary(self):
+        converged_after = None
+        for at, expected, current in zip(self.times, self.expected,
+                                         self.current):
+            if expected == current:
+                converged_after = at
+                break
+        return {
+            'probes': len(self.times),
+            'converged_after': converged_after,
+            'probe_time': dict(
+                ('p{0}'.format(percent),
+                 self._percentile(self.durations, percent))
+                for percent in (50, 90, 99, 100)),
+        }
+
+    def result(self):
+        return {
+            't': self.times,
+            'probe_time': self.durations,
+            'expected': self.expected,
+            'current': self.current,
+            'summary': self.summary(),
+        }
+
+    def dump(self, path, **labels):
+        "Append the timeline as one json line, errors are ignored."
+        entry = dict(labels, started=round(self.start, 3), **self.result())
+        try:
+            with open(path, 'a') as timeline_file:
+                timeline_file.write(json.dumps(entry, sort_keys=True) + "\n")
+        except (IOError, OSError):
+            pass
+
+
+def timeline_report(module, timeline, **labels):
+    """Return the timeline result extras and append it to timeline_file.
+
+    labels are added to the json line to tell the runs apart.
+
+    """
+    if timeline is None:
+        return {}
+    if module.params.get("timeline_file"):
+        timeline.dump(module.params["timeline_file"], **labels)
+    if module.params.get("timeline"):
+        return {'timeline': timeline.result()}
+    return {}
+
+
+# Exit status of timeout(1) when it had to stop (124) or kill (137) a command.
+TIMEOUT_RCS = (124, 137)
+# Seconds left to a stopped command before it is killed.
+KILL_GRACE = 5
+
+
+class Deadline(object):
+    """Time budget shared by all the operations of a module run.
+
+    The nested waits only get what is left of the timeout, and the
+    commands are run under timeout(1) so none of them outlives it.
+
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.end = time.time() + timeout
+
+    def remaining(self):
+        return max(self.end - time.time(), 0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def exhausted(self, cmd):
+        "Message for a command the budget leaves no time to run."
+        return "Timeout of %ss reached before `%s` could run" % (
+            self.timeout, cmd if isinstance(cmd, str) else ' '.join(cmd))
+
+    def seconds(self):
+        "Whole seconds left, at least one, for the --timeout of the tools."
+        return max(int(math.ceil(self.remaining())), 1)
+
+    def wrap(self, cmd):
+        "Prefix cmd with timeout(1) to stop it when the budget runs out."
+        prefix = ['timeout', '-k', str(KILL_GRACE), str(self.seconds())]
+        if isinstance(cmd, list):
+            return prefix + cmd
+        return "%s %s" % (' '.join(prefix), cmd)
+
+
+def process_start():
+    "Return when the process started, from /proc, or None."
+    try:
+        with open('/proc/self/stat') as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        ticks = os.sysconf('SC_CLK_TCK')
+        return time.time() - uptime + float(fields[19]) / ticks
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class ProfilePhase(object):
+    "Time the block as a phase of the profiler, if it is enabled."
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.profiler.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        if self.profiler.enabled:
+            self.profiler.leave()
+        return False
+
+
+class Profiler(object):
+    """Wall and cpu time of the phases of a module run.
+
+    It does nothing until started.  Phases nest, and the time of a phase
+    excludes the phases run inside it, so the phases add up to the total.
+    In cpu mode cProfile runs too and the functions with the most own
+    time are reported.  In memory mode tracemalloc gives the peak
+    allocations of each phase (python 3.9 is needed to reset the peak
+    between phases, before that it is the peak of the run so far).
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.mode = None
+        self.phases = {}
+        self._stack = []
+        self._profile = None
+        self._tracing = False
+        self._origin = None
+
+    @staticmethod
+    def now():
+        "Return the wall and the process cpu time."
+        times = os.times()
+        return time.time(), times[0] + times[1]
+
+    def _memory(self):
+        if self._tracing:
+            return tracemalloc.get_traced_memory()
+        return (0, 0)
+
+    def start(self, mode, started=None):
+        """Start profiling, the main phase being open until the module exits.
+
+        started is the `now()` before the arguments were parsed.
+
+        """
+        self.enabled = True
+        self.mode = mode
+        wall, cpu = started or self.now()
+        begin = process_start()
+        self._origin = wall
+        if begin is not None and begin <= wall:
+            self._origin = begin
+            self.record('startup', wall - begin, cpu)
+        now_wall, now_cpu = self.now()
+        self.record('arguments', now_wall - wall, now_cpu - cpu)
+        if mode in ('memory', 'full') and tracemalloc is not None:
+            tracemalloc.start()
+            self._tracing = True
+        if mode in ('cpu', 'full'):
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self.enter('main')
+
+    def phase(self, name):
+        return ProfilePhase(self, name)
+
+    def enter(self, name):
+        wall, cpu = self.now()
+        current, peak = self._memory()
+        if self._stack:
+            self._stack[-1][6] = max(self._stack[-1][6], peak)
+        if self._tracing and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        # name, wall, cpu, wall and cpu of the inner phases, memory at
+        # the start and peak.
+        self._stack.append([name, wall, cpu, 0.0, 0.0, current, current])
+
+    def leave(self):
+        frame = self._stack.pop()
+        wall, cpu = self.now()
+        peak = max(frame[6], self._memory()[1])
+        self.record(frame[0], wall - frame[1] - frame[3],
+                    cpu - frame[2] - frame[4],
+                    peak - frame[5] if self._tracing else None)
+        if self._stack:
+            self._stack[-1][3] += wall - frame[1]
+            self._stack[-1][4] += cpu - frame[2]
+            self._stack[-1][6] = max(self._stack[-1][6], peak)
+
+    def record(self, name, wall, cpu, peak=None, phases=None):
+        "Add a run of the phase name."
+        phases = self.phases if phases is None else phases
+        phase = phases.setdefault(name, {'calls': 0, 'wall': 0.0,
+                                         'cpu': 0.0})
+        phase['calls'] += 1
+        phase['wall'] += wall
+        phase['cpu'] += cpu
+        if peak is not None:
+            phase['peak_kb'] = max(phase.get('peak_kb', 0), peak // 1024)
+
+    def _hotspots(self, limit=10):
+        self._profile.disable()
+        stats = pstats.Stats(self._profile).stats
+        top = sorted(stats.items(), key=lambda item: item[1][2],
+                     reverse=True)[:limit]
+        return [{'function': "{0}:{1}({2})".format(
+                    os.path.basename(filename), line, name),
+                 'calls': calls, 'own': round(own, 4),
+                 'cumulative': round(cumulative, 4)}
+                for (filename, line, name),
+                (_, calls, own, cumulative, _) in top]
+
+    def report(self):
+        "Return the breakdown, counting the open phases up to now."
+        wall, cpu = self.now()
+        phases = dict((name, dict(phase))
+                      for name, phase in self.phases.items())
+        peak = self._memory()[1]
+        inner_wall = inner_cpu = 0.0
+        for frame in reversed(self._stack):
+            peak = max(peak, frame[6])
+            self.record(frame[0], wall - frame[1] - frame[3] - inner_wall,
+                        cpu - frame[2] - frame[4] - inner_cpu,
+                        peak - frame[5] if self._tracing else None,
+                        phases=phases)
+            inner_wall = wall - frame[1]
+            inner_cpu = cpu - frame[2]
+        for phase in phases.values():
+            phase['wall'] = round(phase['wall'], 4)
+            phase['cpu'] = round(phase['cpu'], 4)
+        result = {'mode': self.mode, 'phases': phases,
+                  'total': {'wall': round(wall - self._origin, 4),
+                            'cpu': round(cpu, 4)}}
+        if self._tracing:
+            result['total']['peak_kb'] = \
+                tracemalloc.get_traced_memory()[1] // 1024
+        if self._profile is not None:
+            result['hotspots'] = self._hotspots()
+        return result
+
+
+PROFILER = Profiler()
+
+
+class CommandRunner(object):
+    """Module wrapper counting the commands it runs.
+
+    It behaves like the AnsibleModule it wraps.  Commands taking several
+    targets (nodes, resources) are run once for all of them with
+    run_batch, and the round trips saved that way are reported, with the
+    number of commands, in the result of the module.  With a deadline,
+    the commands are stopped when it is reached, and none starts after.
+
+    """
+
+    def __init__(self, module, deadline=None):
+        self.module = module
+        self.deadline = deadline
+        self.commands = 0
+        self.saved_round_trips = 0
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def _check_timeout(self, rc, cmd):
+        if rc in TIMEOUT_RCS and self.deadline.expired():
+            self.fail_json(msg="Timeout of %ss reached, `%s` was stopped" %
+                           (self.deadline.timeout, cmd))
+
+    def run_command(self, cmd, *args, **kwargs):
+        if self.deadline is not None and self.deadline.expired():
+            self.fail_json(msg=self.deadline.exhausted(cmd))
+            return TIMEOUT_RCS[0], '', ''
+        self.commands += 1
+        with PROFILER.phase('commands'):
+            if self.deadline is None:
+                return self.module.run_command(cmd, *args, **kwargs)
+            rc, out, err = self.module.run_command(self.deadline.wrap(cmd),
+                                                   *args, **kwargs)
+        self._check_timeout(rc, cmd)
+        return rc, out, err
+
+    def run_parallel(self, cmds, concurrency=4):
+        """Run the commands, lists of arguments, `concurrency` at a time.
+
+        Return the (rc, out, err) of each command, like run_command.
+
+        """
+        results = []
+        step = max(concurrency, 1)
+        for i in range(0, len(cmds), step):
+            batch = []
+            for cmd in cmds[i:i + step]:
+                if self.deadline is not None and self.deadline.expired():
+                    self.fail_json(msg=self.deadline.exhausted(cmd))
+                    return results
+                self.commands += 1
+                args = cmd if self.deadline is None \
+                    else self.deadline.wrap(cmd)
+                try:
+                    batch.append((cmd, subprocess.Popen(
+                        args, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)))
+                except (IOError, OSError) as error:
+                    self.fail_json(rc=error.errno, msg=str(error),
+                                   cmd=' '.join(cmd))
+                    return results
+            for cmd, proc in batch:
+                with PROFILER.phase('commands'):
+                    out, err = proc.communicate()
+                if isinstance(out, bytes):
+                    out = out.decode('utf-8', 'replace')
+                if isinstance(err, bytes):
+                    err = err.decode('utf-8', 'replace')
+                if self.deadline is not None:
+                    self._check_timeout(proc.returncode, ' '.join(cmd))
+                results.append((proc.returncode, out, err))
+        return results
+
+    def run_batch(self, cmd, targets, *args, **kwargs):
+        "Run `cmd target1 target2 ...` once."
+        self.saved_round_trips += max(len(targets) - 1, 0)
+        return self.run_command("%s %s" % (cmd, ' '.join(targets)),
+                                *args, **kwargs)
+
+    def report(self):
+        return {'commands': self.commands,
+                'saved_round_trips': self.saved_round_trips}
+
+    def exit_json(self, **kwargs):
+        kwargs.setdefault('commands', self.report())
+        if PROFILER.enabled:
+            kwargs.setdefault('profile', PROFILER.report())
+        return self.module.exit_json(**kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs.setdefault('commands', self.report())
+        if PROFILER.enabled:
+            kwargs.setdefault('profile', PROFILER.report())
+        return self.module.fail_json(**kwargs)
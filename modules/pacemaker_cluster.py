@@ -17,8 +17,14 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import os
 import time
+from io import BytesIO
+import xml.etree.ElementTree as ElementTree
 from distutils.version import StrictVersion
+from ansible.module_utils.pacemaker import (
+    CACHE_DIR, PROFILER, CommandRunner, Deadline, Profiler,
+    StatusCache, Timeline, timeline_report)
 
 DOCUMENTATION = '''
 ---
@@ -48,7 +54,10 @@ options:
       default: None
     timeout:
       description:
-        - Timeout when the module should considered that the action has failed
+        - Timeout when the module should considered that the action has failed.
+          It covers the whole run of the module, a restart stops and starts
+          the cluster within it, and the commands still running when it is
+          reached are killed.
       required: false
       default: 300
     force:
@@ -56,6 +65,46 @@ options:
         - Force the change of the cluster state
       required: false
       default: true
+    cleanup_concurrency:
+      description:
+        - With state=cleanup, how many `crm_resource --cleanup` can run at
+          the same time. Only the resources with failures or failcounts are
+          cleaned, on the nodes where they failed (on `node` only when it is
+          set), then the module waits once for the cluster to settle.
+      required: false
+      default: 4
+    cache_ttl:
+      description:
+        - How many seconds the cluster status can be reused by other
+          invocations on the same host when no change is needed. 0 disables
+          the cache. Any change of the cluster drops the cached status.
+      required: false
+      default: 0
+    cache_dir:
+      description:
+        - Host-local directory where the status snapshots are kept.
+      required: false
+      default: /run/ansible-pacemaker
+    timeline:
+      description:
+        - Return the timeline of the probes of the waits, as arrays of probe
+          end time, probe duration, expected and current state, with a
+          summary.
+      required: false
+      default: false
+    timeline_file:
+      description:
+        - Append the timeline as one json line to this local file.
+      required: false
+      default: None
+    profile:
+      description:
+        - Return the wall and cpu time of each phase of the run. C(cpu)
+          adds the top functions from cProfile, C(memory) the peak
+          allocations of each phase from tracemalloc, C(full) both.
+      choices: ['none', 'phases', 'cpu', 'memory', 'full']
+      required: false
+      default: none
 requirements:
     - "python >= 2.6"
 '''
@@ -67,6 +116,13 @@ EXAMPLES = '''
   tasks:
     - name: get cluster state
       pacemaker_cluster: state=online
+
+- name: Clean the failed resources
+  hosts: localhost
+  gather_facts: no
+  tasks:
+    - name: cleanup
+      pacemaker_cluster: state=cleanup cleanup_concurrency=8
 '''
 
 RETURN = '''
@@ -75,46 +131,236 @@ change:
     type: bool
 out:
     description: The output of the current state of the cluster. It return a
-                 list of the nodes state.
+                 list of the nodes state, online, offline, or unknown for
+                 the other nodes when the cluster does not run on this
+                 node, as crm_mon sees them. Without node, the state of the
+                 cluster on this node, online, partial (starting or
+                 stopping), no-quorum or offline. With state=cleanup, the
+                 list of the resources cleaned on each node.
     type: string
-    sample: "out": [["  overcloud-controller-0", " Online"]]}
+    sample: "out": [["overcloud-controller-0", "online"]]}
 rc:
     description: exit code of the module
     type: bool
+commands:
+    description: How many commands the module ran, and how many round trips
+                 to pcs were saved by running commands for several nodes at
+                 once.
+    type: dict
+    sample: {"commands": 4, "saved_round_trips": 2}
+timeline:
+    description: When timeline is set and the cluster state was changed, the
+                 probes of the waits.
+    type: dict
+    sample: {"t": [0.52, 1.13], "probe_time": [0.52, 0.61],
+             "expected": ["online", "online"],
+             "current": ["offline", "online"],
+             "summary": {"probes": 2, "converged_after": 1.13,
+                         "probe_time": {"p50": 0.52, "p90": 0.61,
+                                        "p99": 0.61, "p100": 0.61}}}
+profile:
+    description: When profile is set, the wall and cpu seconds of each
+                 phase of the run, not counting its inner phases. Most of a
+                 start or a stop is spent waiting for pcs, in commands.
+    type: dict
+    sample: {"mode": "phases", "total": {"wall": 14.2, "cpu": 1.3},
+             "phases": {"startup": {"calls": 1, "wall": 0.4, "cpu": 0.3},
+                        "arguments": {"calls": 1, "wall": 0.0, "cpu": 0.0},
+                        "commands": {"calls": 9, "wall": 13.7, "cpu": 0.9},
+                        "main": {"calls": 1, "wall": 0.1, "cpu": 0.1}}}
 '''
 
-def get_cluster_status(module):
-    cmd_partition = "crm_node -q"
-    partition_rc, partition_out, partition_err = module.run_command(cmd_partition)
-    if partition_out.strip() != "1": # we're not in a quorate partition or cluster is down
-        return 'offline'
-    cmd = "pcs cluster status"
-    rc, out, err = module.run_command(cmd)
+CLUSTER_STATUS_KEY = 'cluster_status'
+
+
+_LOCAL_NODE = {}
+
+
+def local_node_name(module, names):
+    "Return the name of this host among the cluster node names."
+    hostname = os.uname()[1]
+    for name in (hostname, hostname.split('.')[0]):
+        if name in names:
+            return name
+    if 'name' not in _LOCAL_NODE:
+        rc, out, err = module.run_command("crm_node -n")
+        _LOCAL_NODE['name'] = out.strip() if rc == 0 else None
+    return _LOCAL_NODE['name']
+
+
+COROSYNC_CONF = '/etc/corosync/corosync.conf'
+NODE_POLL_INTERVAL = 1
+
+
+def corosync_nodes(path=COROSYNC_CONF):
+    "Return the node names of the corosync configuration."
+    names = []
+    node = None
+    try:
+        with open(path) as conf:
+            for line in conf:
+                line = line.split('#')[0].strip()
+                if line.replace(' ', '') == 'node{':
+                    node = {}
+                elif node is not None and line == '}':
+                    name = node.get('name', node.get('ring0_addr'))
+                    if name:
+                        names.append(name)
+                    node = None
+                elif node is not None and ':' in line:
+                    key, value = line.split(':', 1)
+                    node[key.strip()] = value.strip()
+    except (IOError, OSError):
+        pass
+    return names
+
+
+def get_membership(module):
+    """Return the current_dc attributes and the online state of the member
+    nodes, from one crm_mon call, or None when the cluster does not run on
+    this node.
+
+    Only the summary and the nodes of the status are parsed.
+
+    """
+    rc, out, err = module.run_command(['crm_mon', '--as-xml'])
     if rc != 0:
+        return None
+    if not isinstance(out, bytes):
+        out = out.encode('utf-8')
+    current_dc = {}
+    nodes = {}
+    with PROFILER.phase('parse'):
+        for event, element in ElementTree.iterparse(BytesIO(out)):
+            if element.tag == 'current_dc':
+                current_dc = element.attrib
+            elif element.tag == 'node' and 'online' in element.attrib:
+                # remote and guest nodes are not started by pcs cluster
+                if element.get('type', 'member') == 'member':
+                    nodes[element.get('name')] = \
+                        element.get('online') == 'true'
+            elif element.tag == 'nodes':
+                break
+    return current_dc, nodes
+
+
+def get_cluster_status(module):
+    """Return the state of the cluster on this node, from one crm_mon call.
+
+    online: the node is a member of a quorate partition with a DC.
+    no-quorum: the node is a member of a partition without quorum.
+    partial: the cluster runs here but the node has not joined yet or no
+    DC has been elected, the cluster is starting or stopping.
+    offline: the cluster does not run on this node.
+
+    """
+    membership = get_membership(module)
+    if membership is None:
         return 'offline'
-    else:
-        return 'online'
+    current_dc, nodes = membership
+    if not nodes.get(local_node_name(module, nodes)):
+        return 'partial'
+    if current_dc.get('present') != 'true':
+        return 'partial'
+    if current_dc.get('with_quorum') != 'true':
+        return 'no-quorum'
+    return 'online'
+
 
-def get_node_status(module, node='all'):
-    if node == 'all':
-        cmd = "pcs cluster pcsd-status %s" % node
+def get_node_states(module, node='all'):
+    """Return the [name, state] of the node, or of all the cluster nodes.
+
+    The state is online or offline, as crm_mon sees it on this node.  When
+    the cluster does not run here, this node is offline and the state of
+    the other nodes of the corosync configuration is unknown.
+
+    """
+    membership = get_membership(module)
+    if membership is not None:
+        nodes = membership[1]
     else:
-        cmd = "pcs cluster pcsd-status"
+        names = corosync_nodes()
+        nodes = dict((name, None) for name in names)
+        local = local_node_name(module, names)
+        if local:
+            nodes[local] = False
+    if node in (None, 'all'):
+        names = sorted(nodes)
+    else:
+        names = [node]
+    states = []
+    for name in names:
+        online = nodes.get(name)
+        if online is None:
+            states.append([name, 'unknown'])
+        else:
+            states.append([name, 'online' if online else 'offline'])
+    return states
+
+def get_failures(module, node=None):
+    """Return the sorted (resource, node) having failures or failcounts.
+
+    They come from the failed actions, the failcounts of the node history
+    and the resources flagged as failed in the crm_mon status.
+
+    """
+    cmd = ['crm_mon', '-r', '-f', '--as-xml']
     rc, out, err = module.run_command(cmd)
-    if rc is 1:
-        module.fail_json(msg="Command execution failed.\nCommand: `%s`\nError: %s" % (cmd, err))
-    status = []
-    for o in out.splitlines():
-        status.append(o.split(':'))
-    return status
+    if rc != 0:
+        module.fail_json(msg="Command execution failed.\nCommand: `%s`\nError: %s" % (' '.join(cmd), err))
+    with PROFILER.phase('parse'):
+        status = ElementTree.fromstring(out)
+    failures = set()
+    for failure in status.iter('failure'):
+        # op_key is <resource>_<task>_<interval>, and tasks like
+        # migrate_to have underscores too.
+        op_key = failure.get('op_key', '')
+        interval = ''.join(c for c in failure.get('interval', '')
+                           if c.isdigit())
+        suffix = '_%s_%s' % (failure.get('task'), interval)
+        if op_key.endswith(suffix):
+            resource = op_key[:-len(suffix)]
+        else:
+            resource = op_key.rsplit('_', 2)[0]
+        if resource and failure.get('node'):
+            failures.add((resource, failure.get('node')))
+    for history in status.findall('node_history/node'):
+        for resource in history.findall('resource_history'):
+            if resource.get('fail-count', '0') != '0':
+                failures.add((resource.get('id'), history.get('name')))
+    for resource in status.iter('resource'):
+        if resource.get('failed') == 'true':
+            for running_on in resource.findall('node'):
+                failures.add((resource.get('id'), running_on.get('name')))
+    return sorted((resource.split(':')[0], failed_node)
+                  for resource, failed_node in failures
+                  if node in (None, 'all', failed_node))
+
+def clean_cluster(module, deadline, targets, concurrency=4):
+    """Cleanup each (resource, node) of targets then wait for the cluster.
+
+    The cleanups run in batches of `concurrency` processes, and the
+    cluster is waited for only once, after all of them, for what is left
+    of the deadline.
 
-def clean_cluster(module, timeout):
-    cmd = "pcs resource cleanup"
+    """
+    crm_resource = module.get_bin_path('crm_resource', required=True)
+    cmds = [[crm_resource, '--cleanup', '-r', resource, '-N', node]
+            for resource, node in targets]
+    errors = []
+    for cmd, (rc, out, err) in zip(cmds, module.run_parallel(cmds,
+                                                             concurrency)):
+        if rc != 0:
+            errors.append("`%s`: %s" % (' '.join(cmd), err.strip()))
+    if errors:
+        module.fail_json(msg="Command execution failed.\n%s" % '\n'.join(errors))
+
+    cmd = [crm_resource, '--wait', '--timeout', '%ss' % deadline.seconds()]
     rc, out, err = module.run_command(cmd)
-    if rc is 1:
-        module.fail_json(msg="Command execution failed.\nCommand: `%s`\nError: %s" % (cmd, err))
+    if rc != 0:
+        module.fail_json(msg="Command execution failed.\nCommand: `%s`\nError: %s" % (' '.join(cmd), err))
 
-def set_cluster(module, state, timeout, force):
+def set_cluster(module, state, deadline, force, timeline=None):
     if state == 'online':
         cmd = "pcs cluster start"
     if state == 'offline':
@@ -125,17 +371,24 @@ def set_cluster(module, state, timeout, force):
     if rc is 1:
         module.fail_json(msg="Command execution failed.\nCommand: `%s`\nError: %s" % (cmd, err))
 
-    t = time.time()
     ready = False
-    while time.time() < t+timeout:
+    cluster_state = 'unknown'
+    while not deadline.expired():
+        probe_start = time.time()
         cluster_state = get_cluster_status(module)
+        if timeline is not None:
+            timeline.probe(probe_start, state, cluster_state)
         if cluster_state == state:
             ready = True
             break
+        time.sleep(min(NODE_POLL_INTERVAL, deadline.remaining()))
     if not ready:
-        module.fail_json(msg="Failed to set the state `%s` on the cluster\n" % (state))
+        module.fail_json(msg="Failed to set the state `%s` on the cluster, it is `%s`\n" % (state, cluster_state),
+                         **timeline_report(module, timeline,
+                                           module_name='pacemaker_cluster',
+                                           state=state))
 
-def set_node(module, state, timeout, force, node='all'):
+def set_node(module, state, deadline, force, node='all'):
     # map states
     if state == 'online':
         cmd = "pcs cluster start"
@@ -144,22 +397,25 @@ def set_node(module, state, timeout, force, node='all'):
         if force:
             cmd = "%s --force" % cmd
 
-    nodes_state = get_node_status(module, node)
-    for node in nodes_state:
-        if node[1].strip().lower() != state:
-            cmd = "%s %s" % (cmd, node[0].strip())
-            rc, out, err = module.run_command(cmd)
-            if rc is 1:
-                module.fail_json(msg="Command execution failed.\nCommand: `%s`\nError: %s" % (cmd, err))
+    # pcs takes all the nodes at once, module is a CommandRunner.
+    targets = [name for name, node_state in get_node_states(module, node)
+               if node_state != state]
+    if targets:
+        rc, out, err = module.run_batch(cmd, targets)
+        if rc != 0:
+            module.fail_json(msg="Command execution failed.\nCommand: `%s %s`\nError: %s" % (cmd, ' '.join(targets), err))
 
-    t = time.time()
-    ready = False
-    while time.time() < t+timeout:
-        nodes_state = get_node_status(module)
-        for node in nodes_state:
-            if node[1].strip().lower() == state:
-                ready = True
-                break
+    # pcs cluster stop returns once the nodes are stopped, the nodes this
+    # node can not see anymore are taken as offline.
+    reached = [state]
+    if state == 'offline':
+        reached.append('unknown')
+    ready = not targets
+    while not ready and not deadline.expired():
+        time.sleep(min(NODE_POLL_INTERVAL, deadline.remaining()))
+        nodes_state = dict(get_node_states(module, node))
+        ready = all(nodes_state.get(name, 'unknown') in reached
+                    for name in targets)
     if not ready:
         module.fail_json(msg="Failed to set the state `%s` on the cluster\n" % (state))
 
@@ -170,69 +426,103 @@ def main():
         node  = dict(default=None),
         timeout=dict(default=300, type='int'),
         force=dict(default=True, type='bool'),
+        cleanup_concurrency=dict(default=4, type='int'),
+        cache_ttl=dict(default=0, type='int'),
+        cache_dir=dict(default=CACHE_DIR, type='path'),
+        timeline=dict(default=False, type='bool'),
+        timeline_file=dict(default=None, type='path'),
+        profile=dict(default='none',
+                     choices=['none', 'phases', 'cpu', 'memory', 'full']),
     )
 
-    module = AnsibleModule(argument_spec,
+    started = Profiler.now()
+    module = CommandRunner(AnsibleModule(argument_spec,
         supports_check_mode=True,
-    )
+    ))
+    if module.params['profile'] != 'none':
+        PROFILER.start(module.params['profile'], started)
+    # Every command and wait below shares this budget.
+    module.deadline = Deadline(module.params['timeout'])
     changed = False
     check_and_fail = module.params['check_and_fail']
     state = module.params['state']
     node = module.params['node']
     force = module.params['force']
-    timeout = module.params['timeout']
+    cache = StatusCache(module.params['cache_dir'], module.params['cache_ttl'])
+    timeline = None
+    if module.params['timeline'] or module.params['timeline_file']:
+        timeline = Timeline()
+    labels = dict(module_name='pacemaker_cluster', state=state)
 
     if state in ['online', 'offline']:
         # Get cluster status
         if node is None:
-            cluster_state = get_cluster_status(module)
+            # Only trust a cached status that needs no change.
+            cluster_state = cache.fetch(CLUSTER_STATUS_KEY,
+                                        lambda: get_cluster_status(module),
+                                        lambda cached: cached == state)
             if cluster_state == state:
                 module.exit_json(changed=changed,
                          out=cluster_state)
             else:
                 if check_and_fail:
                     module.fail_json(msg="State not found to be in %s " % state)
-                set_cluster(module, state, timeout, force)
+                cache.clear()
+                set_cluster(module, state, module.deadline, force, timeline)
                 cluster_state = get_cluster_status(module)
                 if cluster_state == state:
                     module.exit_json(changed=True,
-                         out=cluster_state)
+                         out=cluster_state,
+                         **timeline_report(module, timeline, **labels))
                 else:
-                    module.fail_json(msg="Fail to bring the cluster %s" % state)
+                    module.fail_json(msg="Fail to bring the cluster %s" % state,
+                         **timeline_report(module, timeline, **labels))
         else:
-            cluster_state = get_node_status(module, node)
+            cluster_state = get_node_states(module, node)
+            if not cluster_state:
+                module.fail_json(msg="No cluster node found")
             # Check cluster state
-            for node_state in cluster_state:
-                if node_state[1].strip().lower() == state:
-                    module.exit_json(changed=changed,
-                             out=cluster_state)
-                else:
-                    if check_and_fail:
-                        module.fail_json(msg="State not found to be in %s " % state)
-                    # Set cluster status if needed
-                    set_cluster(module, state, timeout, force)
-                    cluster_state = get_node_status(module, node)
-                    module.exit_json(changed=True,
-                             out=cluster_state)
+            if all(node_state == state
+                   for name, node_state in cluster_state):
+                module.exit_json(changed=changed,
+                         out=cluster_state)
+            if check_and_fail:
+                module.fail_json(msg="State not found to be in %s " % state)
+            # Set nodes status if needed
+            cache.clear()
+            set_node(module, state, module.deadline, force, node)
+            cluster_state = get_node_states(module, node)
+            module.exit_json(changed=True,
+                     out=cluster_state)
 
     if state in ['restart']:
-        set_cluster(module, 'offline', timeout, force)
+        cache.clear()
+        set_cluster(module, 'offline', module.deadline, force, timeline)
         cluster_state = get_cluster_status(module)
         if cluster_state == 'offline':
-            set_cluster(module, 'online', timeout, force)
+            set_cluster(module, 'online', module.deadline, force, timeline)
             cluster_state = get_cluster_status(module)
             if cluster_state == 'online':
                 module.exit_json(changed=True,
-                     out=cluster_state)
+                     out=cluster_state,
+                     **timeline_report(module, timeline, **labels))
             else:
-                module.fail_json(msg="Failed during the restart of the cluster, the cluster can't be started")
+                module.fail_json(msg="Failed during the restart of the cluster, the cluster can't be started",
+                     **timeline_report(module, timeline, **labels))
         else:
-            module.fail_json(msg="Failed during the restart of the cluster, the cluster can't be stopped")
+            module.fail_json(msg="Failed during the restart of the cluster, the cluster can't be stopped",
+                 **timeline_report(module, timeline, **labels))
 
     if state in ['cleanup']:
-        set_cluster(module, state, timeout, force)
+        targets = get_failures(module, node)
+        if not targets:
+            module.exit_json(changed=False, out=[])
+        cache.clear()
+        clean_cluster(module, module.deadline, targets,
+                      module.params['cleanup_concurrency'])
         module.exit_json(changed=True,
-                 out=cluster_state)
+                 out=[{'resource': resource, 'node': failed_node}
+                      for resource, failed_node in targets])
 
 from ansible.module_utils.basic import *
 if __name__ == '__main__':
@@ -22,18 +22,109 @@ version_added: "2.3"
 author: "Sofer Athlan-Guyot (chem)"
 description:
    - Check if a resource is completly started in a pacemaker cluster.
-   - This works for master/slave, clone, primitive resource.
+   - This works for master/slave, clone, bundle, group and primitive
+     resource, including the connection resources of remote nodes.
 options:
     resource:
       description:
         - The name of the resource to check, without any "-clone", "-master"
-          suffix.
-      required: true
+          suffix. Required unless resources or snapshots is given.
+      required: false
     max_wait:
       description:
         - How many seconds should we wait for the resource to be active.
+          The resource is always checked once. The commands still running
+          30 seconds after max_wait are stopped.
       required: false
       default: 5
+    cache_ttl:
+      description:
+        - How many seconds a crm_mon status snapshot can be reused by
+          other invocations on the same host. 0 disables the cache.
+      required: false
+      default: 0
+    cache_dir:
+      description:
+        - Host-local directory where the status snapshots are kept.
+      required: false
+      default: /run/ansible-pacemaker
+    with_dependencies:
+      description:
+        - Also wait for every resource the resource depends on through
+          ordering and colocation constraints, each one being checked as
+          soon as its own dependencies are active.
+      required: false
+      default: false
+    timeline:
+      description:
+        - Return the timeline of the probes, as arrays of probe end time,
+          probe duration, expected and current count, with a summary.
+      required: false
+      default: false
+    timeline_file:
+      description:
+        - Append the timeline as one json line to this local file.
+      required: false
+      default: None
+    watch:
+      description:
+        - Instead of waiting for the resource to be active, watch the
+          resource (and the resources list) for watch_duration seconds and
+          emit an event each time one goes from active to inactive or back.
+          Meant to be run as an async task.
+      required: false
+      default: false
+    resources:
+      description:
+        - The resources to watch, in addition to resource. With
+          snapshots, the resources to return, all of them by default.
+      required: false
+      default: None
+    watch_duration:
+      description:
+        - How many seconds to watch, 0 to watch until the task is stopped.
+          The last read of the status can take 30 seconds more.
+      required: false
+      default: 60
+    watch_interval:
+      description:
+        - How many seconds between two reads of the cluster status.
+      required: false
+      default: 2
+    events_file:
+      description:
+        - Append the events as json lines to this local file, as they
+          happen. The module only returns the last 1000 events.
+      required: false
+      default: None
+    snapshots:
+      description:
+        - Local crm_mon xml files (crm_mon -r --as-xml) to evaluate instead
+          of the live cluster. The module returns, for every snapshot, the
+          expected and current count of every resource and whether it is
+          active. The clone and bundle instances a snapshot lists are the
+          ones expected. A snapshot does not tell how many instances of a
+          master resource are promoted, its expected count is null and it
+          is active with at least one promoted instance, unless
+          expected_counts gives it.
+      required: false
+      default: None
+    expected_counts:
+      description:
+        - With snapshots, the expected count of some resources, to use
+          instead of the one read from the snapshots.
+      required: false
+      default: None
+    profile:
+      description:
+        - Return the time spent in each phase of the run (startup,
+          arguments, commands, ...), wall and cpu. C(cpu) also reports the
+          functions with the most own time, from cProfile, C(memory) the
+          peak allocations of each phase, from tracemalloc (python 3),
+          C(full) both.
+      choices: ['none', 'phases', 'cpu', 'memory', 'full']
+      required: false
+      default: none
 
 '''
 
@@ -48,6 +139,54 @@ EXAMPLES = '''
         resource: galera
         max_wait: 10
 
+- name: Check a batch of resources, reusing the status for 2 seconds
+  hosts: localhost
+  gather_facts: no
+  tasks:
+    - name: resource ready
+      pacemaker_is_active:
+        resource: "{{ item }}"
+        cache_ttl: 2
+      with_items:
+        - haproxy
+        - galera
+        - redis
+
+- name: Ensure cinder-volume and everything it depends on are started
+  hosts: localhost
+  gather_facts: no
+  tasks:
+    - name: cinder-volume ready
+      pacemaker_is_active:
+        resource: openstack-cinder-volume
+        with_dependencies: yes
+        max_wait: 300
+
+- name: Watch the main resources during the upgrade
+  hosts: localhost
+  gather_facts: no
+  tasks:
+    - name: watch
+      pacemaker_is_active:
+        watch: yes
+        resources: [galera, rabbitmq, haproxy, redis]
+        watch_duration: 3600
+        events_file: /var/log/pacemaker-watch.jsonl
+      async: 3700
+      poll: 0
+
+- name: Check the resources in the archived status of the deployments
+  hosts: localhost
+  gather_facts: no
+  tasks:
+    - name: readiness
+      pacemaker_is_active:
+        snapshots:
+          - /srv/crm_mon/deploy-1.xml
+          - /srv/crm_mon/deploy-2.xml
+        expected_counts:
+          galera: 3
+
 '''
 
 RETURN = '''
@@ -58,6 +197,60 @@ out:
     description: A short summary of the resource.
     type: string
     sample: {"out": "Resource galera is active."}
+dependencies:
+    description: When with_dependencies is set, the seconds it took for
+                 each resource of the dependency closure to be active.
+    type: dict
+    sample: {"haproxy": 0.0, "openstack-cinder-volume": 12.03}
+critical_path:
+    description: When with_dependencies is set, the chain of dependencies
+                 which was the last to be active.
+    type: list
+    sample: [{"resource": "haproxy", "ready_after": 0.0},
+             {"resource": "openstack-cinder-volume", "ready_after": 12.03}]
+timeline:
+    description: When timeline is set, the probes of the wait.
+    type: dict
+    sample: {"t": [0.08, 1.16], "probe_time": [0.08, 0.07],
+             "expected": [3, 3], "current": [2, 3],
+             "summary": {"probes": 2, "converged_after": 1.16,
+                         "probe_time": {"p50": 0.07, "p90": 0.08,
+                                        "p99": 0.08, "p100": 0.08}}}
+commands:
+    description: How many commands the module ran.
+    type: dict
+    sample: {"commands": 3, "saved_round_trips": 0}
+events:
+    description: When watch is set, the changes of state of the resources,
+                 the first one of each resource being its initial state.
+                 Only the last 1000 are kept, events_file has them all.
+                 When the status can not be read, active and current are
+                 null and error has the crm_mon error.
+    type: list
+    sample: [{"time": 1500281541.2, "resource": "galera", "active": true,
+              "expected": 3, "current": 3},
+             {"time": 1500281602.7, "resource": "galera", "active": false,
+              "expected": 3, "current": 2}]
+readiness:
+    description: When snapshots is set, the expected and current count of
+                 each resource and whether it is active, one row per
+                 snapshot.
+    type: dict
+    sample: {"snapshots": ["deploy-1.xml", "deploy-2.xml"],
+             "resources": ["galera", "haproxy"],
+             "expected": [[3, 3], [3, 3]], "current": [[2, 3], [3, 3]],
+             "ready": [[false, true], [true, true]]}
+profile:
+    description: When profile is set, the wall and cpu seconds of each
+                 phase, without its inner phases, and of the whole run.
+    type: dict
+    sample: {"mode": "cpu", "total": {"wall": 1.92, "cpu": 0.61},
+             "phases": {"startup": {"calls": 1, "wall": 0.41, "cpu": 0.35},
+                        "arguments": {"calls": 1, "wall": 0.01, "cpu": 0.01},
+                        "commands": {"calls": 2, "wall": 1.43, "cpu": 0.02},
+                        "main": {"calls": 1, "wall": 0.07, "cpu": 0.07}},
+             "hotspots": [{"function": "pacemaker_is_active.py:420(__init__)",
+                           "calls": 2, "own": 0.03, "cumulative": 0.04}]}
 
 '''
 
@@ -70,34 +263,218 @@ version: "1.0"
 
 # Should be at the top (flake8 E402), but ansible requires that module
 # import being after metadata.
-import subprocess
+import json
+from array import array
+from collections import deque
+from io import BytesIO
+import time
 from time import sleep
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.pacemaker import (
+    CACHE_DIR, PROFILER, CommandRunner, Deadline, Profiler, StatusCache,
+    Timeline,
+    timeline_report)
 from lxml import etree
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+CRM_MON_KEY = 'crm_mon'
+# Seconds a probe (crm_mon, crm_resource, cibadmin, pcs) gets on top of
+# max_wait or watch_duration before its commands are stopped.
+PROBE_TIMEOUT = 30
+# crm_mon 2.1 reports the roles of promotable resources with new names.
+ROLE_ALIASES = {'Promoted': 'Master', 'Unpromoted': 'Slave'}
+_INTERNED = {}
+
+
+def intern_value(value):
+    "Return a single shared copy of the repeated strings of the status."
+    return _INTERNED.setdefault(value, value)
+
+
+class PollStatus(object):
+    """Status shared by all the resources checked during one poll.
+
+    It has the same interface as StatusCache, which it can front, so
+    crm_mon is run only once per poll whatever the number of resources.
+
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.values = {}
+
+    def get(self, key):
+        if key in self.values:
+            return self.values[key]
+        if self.cache is not None:
+            return self.cache.get(key)
+        return None
+
+    def put(self, key, value):
+        self.values[key] = value
+        if self.cache is not None:
+            self.cache.put(key, value)
+
+    def refresh(self):
+        "Forget the current status, the next get will read the live one."
+        self.values = {}
+        if self.cache is not None:
+            self.cache.ttl = 0
+
+
+class InstanceRecord(object):
+    "An instance of a primitive resource, on the nodes it runs on."
+    __slots__ = ('id', 'role', 'active', 'failed', 'orphaned', 'nodes',
+                 'parent')
+    tag = 'resource'
+
+    def __init__(self, attrs, parent):
+        self.id = intern_value(attrs.get('id').split(':')[0])
+        role = attrs.get('role')
+        self.role = intern_value(ROLE_ALIASES.get(role, role))
+        self.active = attrs.get('active') == 'true'
+        self.failed = attrs.get('failed') == 'true'
+        self.orphaned = attrs.get('orphaned') == 'true'
+        self.nodes = ()
+        self.parent = parent
+
+    def is_active(self, role):
+        "True if the instance is running in role and has not failed."
+        return (self.active and not self.failed and not self.orphaned and
+                self.role == role)
+
+
+class CollectionRecord(object):
+    """A clone (a master when multi_state), group, bundle or bundle replica.
+
+    children holds the records directly inside it, in the crm_mon order.
+
+    """
+    __slots__ = ('id', 'tag', 'multi_state', 'parent', 'children')
+
+    def __init__(self, tag, attrs, parent):
+        self.tag = intern_value(tag)
+        self.id = attrs.get('id')
+        self.multi_state = attrs.get('multi_state') == 'true'
+        self.parent = parent
+        self.children = []
+
+    def instances(self):
+        "All the primitive instances inside, at any depth."
+        for child in self.children:
+            if child.tag == 'resource':
+                yield child
+            else:
+                for instance in child.instances():
+                    yield instance
+
+
+class Status(object):
+    """Parsed crm_mon status.
+
+    The records are built directly from the parser events, without
+    keeping the lxml tree.  The resources (primitives instances, clones,
+    groups and bundles) are indexed by id, with the ":N" suffix of unique
+    clone instances removed, so lookups don't depend on the number of
+    instances in the cluster.  The node attributes (crm_mon -A) are kept
+    by node name.
+
+    """
+
+    collections = ('clone', 'group', 'bundle', 'replica')
+
+    def __init__(self, xml_string):
+        if not isinstance(xml_string, bytes):
+            xml_string = xml_string.encode('utf-8')
+        self.node_attributes = {}
+        self.resources = []
+        self.index = {}
+        section = None
+        stack = []
+        for event, element in etree.iterparse(BytesIO(xml_string),
+                                              events=('start', 'end')):
+            tag = element.tag
+            if event == 'end':
+                if tag == section:
+                    section = None
+                elif section == 'resources' and tag != 'node':
+                    stack.pop()
+                element.clear()
+                continue
+            if section is None:
+                if tag in ('resources', 'node_attributes'):
+                    section = tag
+                continue
+            attrs = element.attrib
+            parent = stack[-1] if stack else None
+            if section == 'node_attributes':
+                if tag == 'node':
+                    attributes = self.node_attributes.setdefault(
+                        attrs.get('name'), {})
+                elif tag == 'attribute':
+                    attributes[attrs.get('name')] = attrs.get('value')
+                continue
+            if tag == 'node':
+                if isinstance(parent, InstanceRecord):
+                    parent.nodes += (intern_value(attrs.get('name')),)
+                continue
+            if tag == 'resource':
+                record = InstanceRecord(attrs, parent)
+            elif tag in self.collections:
+                record = CollectionRecord(tag, attrs, parent)
+            else:
+                stack.append(None)
+                continue
+            if parent is None:
+                self.resources.append(record)
+            else:
+                parent.children.append(record)
+            if tag != 'replica':
+                self.index.setdefault(record.id.split(':')[0],
+                                      []).append(record)
+            stack.append(record)
+
+
+_LAST_STATUS = {}
+
+
+def parse_status(xml_string):
+    "Parse a crm_mon status, reusing the last parse of the same output."
+    if _LAST_STATUS.get('xml') != xml_string:
+        with PROFILER.phase('parse'):
+            _LAST_STATUS['status'] = Status(xml_string)
+        _LAST_STATUS['xml'] = xml_string
+    return _LAST_STATUS['status']
 
 
 class Resource(object):
     "Base clase for resource and resource factory."
     get_type = None
 
-    def _filter_xpath(self, xpath):
-        "Filter the cib on some xpath."
-        xml_string = self.mod.run_command(['crm_mon', '-r', '--as-xml'],
-                                          {'check_rc': True})[1]
-        tree = etree.fromstring(str(xml_string))
-        return tree.xpath(xpath)
+    def _crm_mon(self):
+        "Return the crm_mon xml status, from the cache if fresh enough."
+        xml_string = None
+        if self.cache is not None:
+            xml_string = self.cache.get(CRM_MON_KEY)
+        if xml_string is None:
+            xml_string = self.mod.run_command(['crm_mon', '-r', '--as-xml'],
+                                              {'check_rc': True})[1]
+            if self.cache is not None:
+                self.cache.put(CRM_MON_KEY, xml_string)
+        return xml_string
+
+    def _status(self):
+        "Return the parsed crm_mon status."
+        return parse_status(self._crm_mon())
 
     def _current_count(self, role):
         "Calculate the current active instance."
-        return int(self._filter_xpath(
-            "count(//resource[@id='{0}' and {1} and {2} and {3} and {4}])"
-            .format(self.name,
-                    "@orphaned='false'",
-                    "@failed='false'",
-                    "@active='true'",
-                    "@role='{0}'".format(role),
-            )
-        ))
+        return sum(1 for res in self._status().index.get(self.name, [])
+                   if res.tag == 'resource' and res.is_active(role))
 
     def _get_crm_resource(self, prop):
         return self.mod.run_command(
@@ -113,16 +490,19 @@ class Resource(object):
             'msg': msg,
         }
 
-    def __init__(self, mod, resource_name):
+    def __init__(self, mod, resource_name, cache=None):
         self.mod = mod
         self.name = resource_name
+        self.cache = cache
 
-    def fail(self, msg):
+    def fail(self, msg, **extra):
         result = self._create_result(msg)
+        result.update(extra)
         return self.mod.fail_json(**result)
 
-    def success(self, msg):
+    def success(self, msg, **extra):
         result = self._create_result(msg)
+        result.update(extra)
         result['changed'] = False
         return self.mod.exit_json(**result)
 
@@ -130,26 +510,54 @@ class Resource(object):
         """Infer the type of a resource from its name.  Factory method.
 
         Using the resource name as a parameter it returns a "Clone",
-        "Master", "Primitive" instance.  If no resource matching the name
+        "Master", "Bundle", "Group" or "Primitive" instance.  The name is
+        looked up exactly in the resource index of the status, then with
+        the usual "-clone", "-master" and "-bundle" suffixes.  The id of a
+        clone or a bundle is resolved to the resource it contains, the one
+        of a cloned group to the group.  If no resource matching the name
         could be found, it return a "Resource" instance.
 
         """
-        res_array = self._filter_xpath(
-            '//resources/*[contains(@id,"{0}")]'.format(self.name)
-        )
-        if len(res_array) == 0:
+        index = self._status().index
+        if self.name not in index:
+            for suffix in ('-clone', '-master', '-bundle'):
+                if self.name + suffix in index:
+                    return Resource(self.mod, self.name + suffix,
+                                    self.cache).from_type()
             return self
 
-        res = res_array[0]
-        if res.tag == 'resource':
-            return Primitive(self.mod, self.name)
-        elif res.tag == 'clone':
-            if res.get('multi_state') == 'false':
-                return Clone(self.mod, self.name)
-            elif res.get('multi_state') == 'true':
-                return Master(self.mod, self.name)
+        res = index[self.name][0]
+        if res.tag == 'clone' and res.children and \
+                res.children[0].tag == 'group':
+            return Group(self.mod, res.children[0].id.split(':')[0],
+                         self.cache)
+        if res.tag in ('clone', 'bundle'):
+            inner = [child.id for child in res.instances()
+                     if not child.id.startswith(self.name + '-')]
+            if inner:
+                return Resource(self.mod, inner[-1],
+                                self.cache).from_type()
+            if res.tag == 'bundle':
+                # bundle without primitive, follow its containers.
+                return Bundle(self.mod, self.name, self.cache)
+            return self
+        elif res.tag == 'group':
+            return Group(self.mod, self.name, self.cache)
 
-        return self
+        parent = res.parent
+        if parent is not None and parent.tag == 'group':
+            parent = parent.parent
+        if parent is None:
+            return Primitive(self.mod, self.name, self.cache)
+        if parent.tag == 'replica':
+            # containers, ips and remote connections are plain primitives
+            if not self.name.startswith(parent.parent.id + '-'):
+                return Bundle(self.mod, self.name, self.cache)
+        elif parent.tag == 'clone':
+            if parent.multi_state:
+                return Master(self.mod, self.name, self.cache)
+            return Clone(self.mod, self.name, self.cache)
+        return Primitive(self.mod, self.name, self.cache)
 
 
 class Master(Resource):
@@ -186,14 +594,18 @@ class Clone(Resource):
     get_type = 'clone'
 
     def _pipe_no_shell(self, cmd1_array, cmd2_array):
-        "Pipe cmd1_array into cmd2_array without using shell interpolation."
+        """Pipe cmd1_array into cmd2_array without using shell interpolation.
+
+        Both commands go through run_command, so the deadline of the
+        module bounds them.
+
+        """
         self.mod.get_bin_path(cmd1_array[0], required=True)
         self.mod.get_bin_path(cmd2_array[0], required=True)
-        cmd1 = subprocess.Popen(cmd1_array, stdout=subprocess.PIPE)
-        cmd2 = subprocess.Popen(cmd2_array,
-                                stdin=cmd1.stdout,
-                                stdout=subprocess.PIPE)
-        return cmd2.communicate()
+        rc, out, err = self.mod.run_command(cmd1_array)
+        rc, out, err = self.mod.run_command(cmd2_array, data=out,
+                                            binary_data=True)
+        return [out, err]
 
     def expected_count(self):
         """Return the expected number of clone resource on the system.
@@ -240,7 +652,495 @@ class Primitive(Clone):
         return 1
 
 
-def is_resource_active(mod):
+CONTAINER_TYPES = ('docker', 'podman', 'rkt')
+
+
+def bundle_containers(bundle):
+    """Return the container instance of each replica of a bundle record.
+
+    A replica also holds the ip, the remote connection and the primitive
+    of the bundle, its container is "<bundle>-docker-N" (or podman, rkt).
+
+    """
+    prefixes = tuple('{0}-{1}-'.format(bundle.id, kind)
+                     for kind in CONTAINER_TYPES)
+    return [next((res for res in replica.instances()
+                  if res.id.startswith(prefixes)), None)
+            for replica in bundle.children]
+
+
+class Bundle(Resource):
+    """Representation of a bundle resource.
+
+    The name is the one of the primitive running inside the containers,
+    or the bundle id itself for bundles without primitive.
+
+    """
+    get_type = 'bundle'
+    role = None
+
+    def _bundle(self):
+        res = self._status().index[self.name][0]
+        while res.tag != 'bundle':
+            res = res.parent
+        return res
+
+    def _instances(self):
+        "Return the instance of the resource in each replica."
+        bundle = self._bundle()
+        if bundle.id != self.name:
+            return self._status().index.get(self.name, [])
+        return bundle_containers(bundle)
+
+    def expected_count(self):
+        """Return the expected number of instance of a bundle resource.
+
+        The bundle configuration is read from the cib.  If the container
+        has a promoted-max (or masters) attribute, that's the number of
+        instances expected in the Master role, otherwise all the replicas
+        are expected to be started.
+
+        """
+        bundle_id = self._bundle().id
+        rc, stdout, stderr = self.mod.run_command(
+            ['cibadmin', '--query', '--xpath',
+             "//bundle[@id='{0}']".format(bundle_id)])
+        if rc != 0:
+            return self.fail(
+                "Unknow error geting the cib for bundle '{0}'."
+                .format(bundle_id)
+            )
+        for container in etree.fromstring(str(stdout)):
+            promoted = container.get('promoted-max', container.get('masters'))
+            if promoted is not None and int(promoted) > 0:
+                self.role = 'Master'
+                return int(promoted)
+            if container.get('replicas') is not None:
+                self.role = 'Started'
+                return int(container.get('replicas'))
+        self.role = 'Started'
+        return 1
+
+    def current_count(self):
+        "Calculate the current active instance."
+        instances = [res for res in self._instances() if res is not None]
+        role = self.role
+        if role is None:
+            promotable = any(res.role in ('Master', 'Slave')
+                             for res in instances)
+            role = 'Master' if promotable else 'Started'
+        return sum(1 for res in instances if res.is_active(role))
+
+
+class Group(Resource):
+    """Representation of a group, active when all its members are started.
+
+    A cloned group has all the members of all its instances.
+
+    """
+    get_type = 'group'
+
+    def _members(self):
+        return [member for group in self._status().index[self.name]
+                for member in group.children]
+
+    def expected_count(self):
+        return len(self._members())
+
+    def current_count(self):
+        "Calculate the number of started members."
+        return sum(1 for member in self._members()
+                   if member.tag == 'resource' and
+                   member.is_active('Started'))
+
+
+class Fleet(object):
+    """Readiness of all the resources over many crm_mon snapshots.
+
+    Each resource instance of each snapshot is a row of the columns
+    snapshot, resource, role, active, failed and node, plus the role the
+    instance needs to count as running.  The counts of all the resources
+    are computed in one grouped pass over the columns, with NumPy when
+    it is available.
+
+    The expected counts come from the snapshots alone: 1 for a primitive,
+    the members of a group, the nodes with the "$resourcename-role"
+    attribute (crm_mon -A) or else the instances listed (crm_mon -r) for a
+    clone, and the replicas of a bundle.  The number of promoted instances
+    of a master is in the cib only: without a count given, it is None and
+    one promoted instance makes the master ready.
+
+    """
+
+    def __init__(self):
+        self.snapshots = []
+        self.resources = []
+        # Compact arrays, that NumPy uses without copying them.
+        self.columns = dict((name, array('i')) for name in
+                            ('snapshot', 'resource', 'role', 'wanted'))
+        self.columns['active'] = array('b')
+        self.columns['failed'] = array('b')
+        self.columns['node'] = []
+        self._index = {}
+        self._aliases = {}
+        self._roles = {}
+        # Expected count of each resource, -1 for the number of its rows
+        # and None when the snapshots do not tell it, and of some
+        # resources in some snapshots.
+        self._fixed = []
+        self._snapshot_fixed = {}
+
+    def _resource(self, name, fixed):
+        if name not in self._index:
+            self._index[name] = len(self.resources)
+            self.resources.append(name)
+            self._fixed.append(fixed)
+        return self._index[name]
+
+    def _role(self, role):
+        return self._roles.setdefault(role, len(self._roles))
+
+    def column(self, name):
+        "Index of the resource name, found like Resource.from_type does."
+        for alias in (name, name + '-clone', name + '-master',
+                      name + '-bundle'):
+            if alias in self._index:
+                return self._index[alias]
+            if alias in self._aliases:
+                return self._aliases[alias]
+        return None
+
+    @staticmethod
+    def _rows(record):
+        """Return the name, wanted role, expected count and instances of a
+        top-level record of the status."""
+        if record.tag == 'resource':
+            return record.id, 'Started', 1, [record]
+        instances = list(record.instances())
+        if record.tag == 'group':
+            return record.id, 'Started', -1, instances
+        if record.tag == 'clone':
+            name = record.children[0].id.split(':')[0] if record.children \
+                else record.id
+            if record.multi_state:
+                return name, 'Master', None, instances
+            return name, 'Started', -1, instances
+        # A bundle: its primitive in each replica, or its containers under
+        # the name of the bundle without suffix, like a clone.
+        inside = [res for res in instances
+                  if not res.id.startswith(record.id)]
+        name = inside[0].id if inside else record.id
+        if not inside:
+            if name.endswith('-bundle'):
+                name = name[:-len('-bundle')]
+            inside = [res for res in bundle_containers(record)
+                      if res is not None]
+        promotable = any(res.role in ('Master', 'Slave') for res in inside)
+        if promotable:
+            return name, 'Master', None, inside
+        return name, 'Started', -1, inside
+
+    def add(self, label, xml_string):
+        "Add the rows of a crm_mon xml snapshot."
+        snapshot = len(self.snapshots)
+        self.snapshots.append(label)
+        with PROFILER.phase('parse'):
+            status = Status(xml_string)
+        columns = self.columns
+        for record in status.resources:
+            name, wanted, fixed, instances = self._rows(record)
+            resource = self._resource(name, fixed)
+            self._aliases[record.id] = resource
+            if record.tag == 'group':
+                for member in record.children:
+                    self._aliases[member.id] = resource
+            if record.tag == 'clone' and wanted == 'Started':
+                role_nodes = sum(
+                    1 for attributes in status.node_attributes.values()
+                    if attributes.get(name + '-role') == 'true')
+                if role_nodes:
+                    self._snapshot_fixed[(snapshot, resource)] = role_nodes
+            wanted = self._role(wanted)
+            for res in instances:
+                columns['snapshot'].append(snapshot)
+                columns['resource'].append(resource)
+                columns['role'].append(self._role(res.role))
+                columns['active'].append(res.active and not res.orphaned)
+                columns['failed'].append(res.failed)
+                columns['node'].append(res.nodes[0] if res.nodes else '')
+                columns['wanted'].append(wanted)
+
+    def _counts(self):
+        """Return the number of rows and of running instances of each
+        resource in each snapshot."""
+        shape = (len(self.snapshots), len(self.resources))
+        columns = self.columns
+        if numpy is not None:
+            def view(name, dtype):
+                return numpy.frombuffer(columns[name], dtype=dtype)
+            snapshot = view('snapshot', numpy.intc)
+            resource = view('resource', numpy.intc)
+            running = ((view('active', numpy.int8) == 1) &
+                       (view('failed', numpy.int8) == 0) &
+                       (view('role', numpy.intc) ==
+                        view('wanted', numpy.intc)))
+            cell = snapshot.astype(numpy.intp) * shape[1] + resource
+            size = shape[0] * shape[1]
+            rows = numpy.bincount(cell, minlength=size).reshape(shape)
+            current = numpy.bincount(cell[running],
+                                     minlength=size).reshape(shape)
+            fixed = numpy.array([-1 if fixed is None else fixed
+                                 for fixed in self._fixed], dtype=int)
+            expected = numpy.where(fixed >= 0, fixed, rows)
+            return rows.tolist(), expected.tolist(), current.tolist()
+        rows = [[0] * shape[1] for _ in range(shape[0])]
+        current = [[0] * shape[1] for _ in range(shape[0])]
+        for snapshot, resource, role, active, failed, wanted in zip(
+                columns['snapshot'], columns['resource'], columns['role'],
+                columns['active'], columns['failed'], columns['wanted']):
+            rows[snapshot][resource] += 1
+            if active and not failed and role == wanted:
+                current[snapshot][resource] += 1
+        expected = [[count if fixed is None or fixed < 0 else fixed
+                     for fixed, count in zip(self._fixed, row)]
+                    for row in rows]
+        return rows, expected, current
+
+    def readiness(self, expected=None, names=None):
+        """Return the readiness matrix, one row per snapshot.
+
+        expected maps resource names to the expected count to use instead
+        of the one read from the snapshots, names restricts the columns.
+
+        """
+        expected = expected or {}
+        rows, expected_counts, current = self._counts()
+        for (snapshot, resource), count in self._snapshot_fixed.items():
+            expected_counts[snapshot][resource] = count
+        names = list(names or self.resources)
+        columns = [self.column(name) for name in names]
+        result = {'snapshots': list(self.snapshots), 'resources': names,
+                  'expected': [], 'current': [], 'ready': []}
+        for snapshot in range(len(self.snapshots)):
+            row_expected, row_current, row_ready = [], [], []
+            for name, col in zip(names, columns):
+                count = 0 if col is None else current[snapshot][col]
+                if name in expected:
+                    wanted = int(expected[name])
+                elif col is None:
+                    wanted = 0
+                elif self._fixed[col] is None:
+                    wanted = None
+                else:
+                    wanted = expected_counts[snapshot][col]
+                row_expected.append(wanted)
+                row_current.append(count)
+                row_ready.append(col is not None and
+                                 rows[snapshot][col] > 0 and
+                                 (count > 0 if wanted is None
+                                  else count == wanted))
+            result['expected'].append(row_expected)
+            result['current'].append(row_current)
+            result['ready'].append(row_ready)
+        return result
+
+
+def _positive_score(constraint):
+    "Return False for optional orders and anti-colocations."
+    if constraint.get('kind') == 'Optional':
+        return False
+    score = constraint.get('score', 'INFINITY').lstrip('+')
+    if score in ('INFINITY', 'inf'):
+        return True
+    try:
+        return int(score) > 0
+    except ValueError:
+        return False
+
+
+def _set_edges(constraint, reverse_sets):
+    """Return the (dependent, dependency) ids of a constraint with sets.
+
+    Inside a sequential set each resource depends on the previous one.
+    Between sets, the resources of a set depend on all the resources of
+    the previous set for orders, of the next set for colocations.
+
+    """
+    edges = []
+    sets = [[ref.get('id') for ref in rsc_set.iter('resource_ref')]
+            for rsc_set in constraint.iter('resource_set')]
+    for rsc_set, refs in zip(constraint.iter('resource_set'), sets):
+        if rsc_set.get('sequential', 'true') == 'true':
+            edges.extend(zip(refs[1:], refs[:-1]))
+    if reverse_sets:
+        sets.reverse()
+    for previous, current in zip(sets[:-1], sets[1:]):
+        edges.extend((then, first) for then in current for first in previous)
+    return edges
+
+
+def dependency_graph(constraints, names):
+    """Build the dependency graph of the resources from the constraints.
+
+    `names` maps the ids used in the constraints (clone, master, group or
+    primitive ids) to the resource names checked by this module.  The
+    graph maps each resource name to the set of names it depends on.
+
+    """
+    graph = {}
+    for constraint in constraints.iter('rsc_order', 'rsc_colocation'):
+        if not _positive_score(constraint):
+            continue
+        if constraint.tag == 'rsc_order':
+            edges = [(constraint.get('then'), constraint.get('first'))]
+        else:
+            edges = [(constraint.get('rsc'), constraint.get('with-rsc'))]
+        if edges[0][0] is None:
+            edges = _set_edges(constraint,
+                               constraint.tag == 'rsc_colocation')
+        for dependent, dependency in edges:
+            for name in names.get(dependent, [dependent]):
+                graph.setdefault(name, set()).update(
+                    dep for dep in names.get(dependency, [dependency])
+                    if dep != name)
+    return graph
+
+
+def resource_names(status):
+    "Map the ids of the crm_mon status to the names of their primitives."
+    names = {}
+    for res in status.resources:
+        if res.tag == 'resource':
+            continue
+        names[res.id] = sorted(set(
+            child.id for child in res.instances()
+            if not child.id.startswith(res.id + '-'))) or [res.id]
+    return names
+
+
+def dependency_closure(graph, name):
+    "Return all the resources name depends on, including itself."
+    closure = set([name])
+    todo = [name]
+    while todo:
+        for dep in graph.get(todo.pop(), ()):
+            if dep not in closure:
+                closure.add(dep)
+                todo.append(dep)
+    return closure
+
+
+def topological_order(graph, names):
+    """Return names with the dependencies of each resource before it.
+
+    The resources of a cycle come in the order they are reached.
+
+    """
+    order = []
+    seen = set()
+    for name in sorted(names):
+        if name in seen:
+            continue
+        todo = [(name, iter(sorted(graph.get(name, ()))))]
+        seen.add(name)
+        while todo:
+            for dep in todo[-1][1]:
+                if dep in names and dep not in seen:
+                    seen.add(dep)
+                    todo.append((dep, iter(sorted(graph.get(dep, ())))))
+                    break
+            else:
+                order.append(todo.pop()[0])
+    return order
+
+
+def critical_path(graph, ready_after, name):
+    "Follow the dependencies that were the last to be ready back from name."
+    path = [name]
+    seen = set(path)
+    while True:
+        deps = [dep for dep in graph.get(path[0], ()) if dep not in seen]
+        if not deps:
+            break
+        last = max(deps, key=lambda dep: ready_after[dep])
+        path.insert(0, last)
+        seen.add(last)
+    return [{'resource': res, 'ready_after': ready_after[res]}
+            for res in path]
+
+
+def are_dependencies_active(mod, cache=None, deadline=None):
+    """Return success if a resource and all its dependencies are active.
+
+    The constraints section of the cib is read once to build the
+    ordering/colocation graph.  Then on each poll, the status is read
+    once and every resource whose dependencies are all active is
+    checked, so independent branches of the graph progress in parallel.
+    Dependencies belonging to a cycle are checked together.
+
+    """
+    max_tries = int(mod.params["max_wait"])
+    resource_name = mod.params["resource"]
+    current_try = 0
+    start = time.time()
+
+    poll = PollStatus(cache)
+    target = Resource(mod, resource_name, poll).from_type()
+    if target.get_type is None:
+        return target.fail("Resource '{0}' doesn't exist in the cib.".format(
+            target.name
+        ))
+
+    constraints = etree.fromstring(str(mod.run_command(
+        ['cibadmin', '--query', '--scope', 'constraints'],
+        check_rc=True)[1]))
+    graph = dependency_graph(constraints, resource_names(target._status()))
+    closure = dependency_closure(graph, target.name)
+    resources = {}
+    for name in closure:
+        resource = Resource(mod, name, poll).from_type()
+        if resource.get_type is None:
+            return resource.fail(
+                "Resource '{0}' doesn't exist in the cib.".format(name))
+        resources[name] = resource
+    waits_for = dict(
+        (name, set(dep for dep in graph.get(name, ())
+                   if name not in dependency_closure(graph, dep)))
+        for name in closure)
+    # A resource is checked in the same poll as its dependencies.
+    order = topological_order(graph, closure)
+
+    expected = {}
+    ready_after = {}
+    while True:
+        for name in order:
+            if name in ready_after or not waits_for[name] <= set(ready_after):
+                continue
+            resource = resources[name]
+            if name not in expected:
+                expected[name] = resource.expected_count()
+            if expected[name] == resource.current_count():
+                ready_after[name] = round(time.time() - start, 2)
+        if len(ready_after) == len(closure):
+            break
+        if current_try >= max_tries-1 or (deadline is not None and
+                                          deadline.expired()):
+            return target.fail(
+                "Max wait time of {0} seconds reached waiting for {1}".format(
+                    max_tries, ", ".join(sorted(closure - set(ready_after)))
+                ), dependencies=ready_after)
+        poll.refresh()
+        with PROFILER.phase('sleep'):
+            sleep(1)
+        current_try += 1
+    return target.success(
+        "{0} resource {1} and its {2} dependencies are active".format(
+            target.get_type, target.name, len(closure) - 1),
+        dependencies=ready_after,
+        critical_path=critical_path(graph, ready_after, target.name))
+
+
+def is_resource_active(mod, deadline=None):
     """Return success if a resource active, failure otherwise.
 
     Takes the resource name as an argument and does the following:
@@ -272,35 +1172,193 @@ def is_resource_active(mod):
     resource_name = mod.params["resource"]
     current_try = 0
 
-    resource = Resource(mod, resource_name).from_type()
+    cache = None
+    cache_ttl = int(mod.params.get("cache_ttl") or 0)
+    if cache_ttl > 0:
+        cache = StatusCache(mod.params.get("cache_dir") or CACHE_DIR,
+                            cache_ttl)
+
+    if mod.params.get("with_dependencies"):
+        return are_dependencies_active(mod, cache, deadline)
+
+    resource = Resource(mod, resource_name, cache).from_type()
     if resource.get_type is None:
         return resource.fail("Resource '{0}' doesn't exist in the cib.".format(
             resource.name
         ))
 
+    timeline = None
+    if mod.params.get("timeline") or mod.params.get("timeline_file"):
+        timeline = Timeline()
+
     resource_expected_count = resource.expected_count()
-    while resource_expected_count != resource.current_count():
-        if current_try >= max_tries-1:
+    while True:
+        probe_start = time.time()
+        resource_current_count = resource.current_count()
+        if timeline is not None:
+            timeline.probe(probe_start, resource_expected_count,
+                           resource_current_count)
+        if resource_expected_count == resource_current_count:
+            break
+        if current_try >= max_tries-1 or (deadline is not None and
+                                          deadline.expired()):
             return resource.fail(
                 "Max wait time of {0} seconds reached waiting for {1}".format(
                     max_tries, resource.name
-                ))
-        sleep(1)
+                ), **timeline_report(mod, timeline,
+                                     module_name='pacemaker_is_active',
+                                     resource=resource.name))
+        if cache is not None:
+            # Retries need the live status, but keep feeding the cache.
+            cache.ttl = 0
+        with PROFILER.phase('sleep'):
+            sleep(1)
         current_try += 1
     return resource.success("{0} resource {1} is active".format(resource.get_type,
-                                                                resource.name))
+                                                                resource.name),
+                            **timeline_report(mod, timeline,
+                                              module_name='pacemaker_is_active',
+                                              resource=resource.name))
+
+
+WATCH_EVENTS = 1000
+
+
+def watch_resources(mod):
+    """Emit an event each time a resource becomes active or inactive.
+
+    crm_mon can only produce its xml status in one-shot mode, so the
+    status is read every watch_interval seconds, and the resources are
+    evaluated on each read.  Expected counts are computed once.  A read
+    that fails, while pacemaker restarts for example, makes the state of
+    the resources unknown (None) and the watch goes on.  Between two
+    reads the module only sleeps.
+
+    """
+    names = list(mod.params.get("resources") or [])
+    if mod.params.get("resource") and mod.params["resource"] not in names:
+        names.insert(0, mod.params["resource"])
+    duration = int(mod.params.get("watch_duration") or 0)
+    interval = max(float(mod.params.get("watch_interval") or 1), 0.1)
+    events_file = mod.params.get("events_file")
+    end = time.time() + duration
+
+    poll = PollStatus()
+    resources = []
+    for name in names:
+        resource = Resource(mod, name, poll).from_type()
+        if resource.get_type is None:
+            return resource.fail(
+                "Resource '{0}' doesn't exist in the cib.".format(name))
+        resources.append((name, resource, resource.expected_count()))
+
+    # A watch without end must not grow without end.
+    events = deque(maxlen=WATCH_EVENTS)
+    count = 0
+    active = {}
+    while True:
+        poll.refresh()
+        rc, xml_string, err = mod.run_command(['crm_mon', '-r', '--as-xml'])
+        if rc == 0:
+            poll.put(CRM_MON_KEY, xml_string)
+        for name, resource, expected in resources:
+            current = None
+            state = None
+            if rc == 0:
+                current = resource.current_count()
+                state = current == expected
+            if name in active and active[name] == state:
+                continue
+            active[name] = state
+            event = {'time': round(time.time(), 1), 'resource': name,
+                     'active': state, 'expected': expected,
+                     'current': current}
+            if rc != 0:
+                event['error'] = err.strip()
+            events.append(event)
+            count += 1
+            if events_file:
+                try:
+                    with open(events_file, 'a') as events_out:
+                        events_out.write(json.dumps(
+                            event, sort_keys=True,
+                            separators=(',', ':')) + "\n")
+                except (IOError, OSError):
+                    pass
+        if duration and time.time() + interval > end:
+            break
+        with PROFILER.phase('sleep'):
+            sleep(interval)
+    return mod.exit_json(
+        changed=False, events=list(events),
+        msg="Watched {0} resources for {1} seconds, {2} events".format(
+            len(resources), duration, count))
+
+
+def evaluate_snapshots(mod):
+    "Exit with the readiness matrix of archived crm_mon snapshots."
+    fleet = Fleet()
+    for path in mod.params["snapshots"]:
+        try:
+            with open(path) as snapshot:
+                fleet.add(path, snapshot.read())
+        except (IOError, OSError, etree.XMLSyntaxError) as error:
+            return mod.fail_json(
+                msg="Cannot read the snapshot '{0}': {1}".format(path, error))
+    names = list(mod.params.get("resources") or [])
+    if mod.params.get("resource") and mod.params["resource"] not in names:
+        names.insert(0, mod.params["resource"])
+    readiness = fleet.readiness(mod.params.get("expected_counts"),
+                                names or None)
+    ready = sum(1 for row in readiness['ready'] if all(row))
+    return mod.exit_json(
+        changed=False, readiness=readiness,
+        msg="{0} of {1} snapshots have all their resources active".format(
+            ready, len(readiness['snapshots'])))
 
 
 def main():
     "Main function called by Ansible."
-    mod = AnsibleModule(
+    started = Profiler.now()
+    mod = CommandRunner(AnsibleModule(
         argument_spec=dict(
-            resource=dict(type='str',required=True),
+            resource=dict(type='str', required=False),
             max_wait=dict(type='int',default=5),  # in seconds
-        )
-    )
+            cache_ttl=dict(type='int', default=0),  # in seconds
+            cache_dir=dict(type='path', default=CACHE_DIR),
+            with_dependencies=dict(type='bool', default=False),
+            timeline=dict(type='bool', default=False),
+            timeline_file=dict(type='path', default=None),
+            watch=dict(type='bool', default=False),
+            resources=dict(type='list', default=None),
+            watch_duration=dict(type='int', default=60),  # in seconds
+            watch_interval=dict(type='float', default=2),  # in seconds
+            events_file=dict(type='path', default=None),
+            snapshots=dict(type='list', default=None),
+            expected_counts=dict(type='dict', default=None),
+            profile=dict(type='str', default='none',
+                         choices=['none', 'phases', 'cpu', 'memory', 'full']),
+        ),
+        required_one_of=[['resource', 'resources', 'snapshots']],
+    ))
+    if mod.params['profile'] != 'none':
+        PROFILER.start(mod.params['profile'], started)
 
-    return is_resource_active(mod)
+    if mod.params['snapshots']:
+        return evaluate_snapshots(mod)
+    if mod.params['watch']:
+        if not (mod.params['resource'] or mod.params['resources']):
+            return mod.fail_json(msg="resource or resources is required "
+                                     "to watch.")
+        if mod.params['watch_duration']:
+            mod.deadline = Deadline(mod.params['watch_duration'] +
+                                    PROBE_TIMEOUT)
+        return watch_resources(mod)
+    if mod.params['resource'] is None:
+        return mod.fail_json(msg="resource is required unless watching.")
+    # max_wait bounds the retries, a probe can always run to completion.
+    mod.deadline = Deadline(max(mod.params['max_wait'], 0) + PROBE_TIMEOUT)
+    return is_resource_active(mod, mod.deadline)
 
 
 if __name__ == '__main__':
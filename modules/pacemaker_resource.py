@@ -18,7 +18,11 @@
 #   under the License.
 
 from distutils.version import StrictVersion
+import re
 import time
+from ansible.module_utils.pacemaker import (
+    CACHE_DIR, PROFILER, CommandRunner, Deadline, Profiler,
+    StatusCache, Timeline, timeline_report)
 
 DOCUMENTATION = '''
 ---
@@ -43,7 +47,10 @@ options:
       default: None
     timeout:
       description:
-        - Timeout when the module should considered that the action has failed
+        - Timeout when the module should considered that the action has failed.
+          It covers the whole run of the module, pcs only waits for what is
+          left of it and the commands still running when it is reached are
+          killed.
       required: false
       default: 300
     check_mode:
@@ -57,6 +64,38 @@ options:
             timeout is reach
         required: false
         default: false
+    cache_ttl:
+        description:
+          - How many seconds the cluster status read in check_mode can be
+            reused by other invocations on the same host. 0 disables the
+            cache. Any other state drops the cached status.
+        required: false
+        default: 0
+    cache_dir:
+        description:
+          - Host-local directory where the status snapshots are kept.
+        required: false
+        default: /run/ansible-pacemaker
+    timeline:
+        description:
+          - Return the timeline of the probes done by wait_for_resource, as
+            arrays of probe end time, probe duration, expected and current
+            state (true when the resource has the state), with a summary.
+        required: false
+        default: false
+    timeline_file:
+        description:
+          - Append the timeline as one json line to this local file.
+        required: false
+        default: None
+    profile:
+        description:
+          - Return the wall and cpu time of each phase of the run. C(cpu)
+            adds the top functions from cProfile, C(memory) the peak
+            allocations of each phase from tracemalloc, C(full) both.
+        choices: ['none', 'phases', 'cpu', 'memory', 'full']
+        required: false
+        default: none
 requirements:
     - "python >= 2.6"
 '''
@@ -71,14 +110,63 @@ EXAMPLES = '''
 '''
 
 RETURN = '''
-
+commands:
+    description: How many commands the module ran, and how many round trips
+                 to pcs were saved by running commands for several targets at
+                 once.
+    type: dict
+    sample: {"commands": 2, "saved_round_trips": 0}
+timeline:
+    description: When timeline is set in check_mode, the probes of the wait.
+    type: dict
+    sample: {"t": [1.02, 2.11], "probe_time": [1.02, 1.09],
+             "expected": [true, true], "current": [false, true],
+             "summary": {"probes": 2, "converged_after": 2.11,
+                         "probe_time": {"p50": 1.02, "p90": 1.09,
+                                        "p99": 1.09, "p100": 1.09}}}
+profile:
+    description: When profile is set, the wall and cpu seconds of each
+                 phase of the run, not counting its inner phases.
+    type: dict
+    sample: {"mode": "memory", "total": {"wall": 3.1, "cpu": 0.5,
+                                         "peak_kb": 2210},
+             "phases": {"startup": {"calls": 1, "wall": 0.4, "cpu": 0.3},
+                        "arguments": {"calls": 1, "wall": 0.0, "cpu": 0.0},
+                        "commands": {"calls": 2, "wall": 2.6, "cpu": 0.1,
+                                     "peak_kb": 64},
+                        "main": {"calls": 1, "wall": 0.1, "cpu": 0.1,
+                                 "peak_kb": 12}}}
 '''
 
+PCS_STATUS_KEY = 'pcs_status_full'
+
+
+def grep_resource(status, resource):
+    """Same lines as `grep -w \"resource[ \\t]\"` on the status output.
 
-def check_resource_state(module, resource, state):
+    Like grep -w, the match is not preceded by a word character, and the
+    whitespace is followed by a non-word character or the end of line.
+
+    """
+    pattern = re.compile(r"(?<!\w)%s[ \t](?=\W|$)" % re.escape(resource))
+    return "\n".join(line for line in status.splitlines()
+                     if pattern.search(line))
+
+
+def check_resource_state(module, resource, state, cache=None):
     # get resources
-    cmd = "bash -c 'pcs status --full | grep -w \"%s[ \t]\"'" % resource
-    rc, out, err = module.run_command(cmd)
+    if cache is None:
+        cmd = "bash -c 'pcs status --full | grep -w \"%s[ \t]\"'" % resource
+        rc, out, err = module.run_command(cmd)
+    else:
+        def read():
+            rc, status, err = module.run_command("pcs status --full")
+            return status if rc == 0 else ''
+        # Only trust a cached status that already has the state we want.
+        status = cache.fetch(
+            PCS_STATUS_KEY, read,
+            lambda cached: state in grep_resource(cached, resource).lower())
+        out = grep_resource(status, resource)
     if state in out.lower():
         return True
 
@@ -88,10 +176,10 @@ def get_resource(module, resource):
     return module.run_command(cmd)
 
 
-def set_resource_state(module, resource, state, timeout):
+def set_resource_state(module, resource, state, deadline):
     cmd = "pcs resource %s %s" % (state, resource)
     if state in ["enable", "disable", "restart"]:
-        cmd += " --wait=%s" % timeout
+        cmd += " --wait=%s" % deadline.seconds()
     cmd_status = module.run_command(cmd)
     if cmd_status[0] == 0 and state == 'delete':
         # pcs delete operations are not atomic, the deletion might
@@ -112,42 +200,73 @@ def main():
         timeout=dict(default=300, type='int'),
         check_mode=dict(default=False, type='bool'),
         wait_for_resource=dict(default=False, type='bool'),
+        cache_ttl=dict(default=0, type='int'),
+        cache_dir=dict(default=CACHE_DIR, type='path'),
+        timeline=dict(default=False, type='bool'),
+        timeline_file=dict(default=None, type='path'),
+        profile=dict(default='none',
+                     choices=['none', 'phases', 'cpu', 'memory', 'full']),
     )
 
-    module = AnsibleModule(argument_spec, supports_check_mode=True)
+    started = Profiler.now()
+    module = CommandRunner(AnsibleModule(argument_spec,
+                                         supports_check_mode=True))
+    if module.params['profile'] != 'none':
+        PROFILER.start(module.params['profile'], started)
+    # Every command and wait below shares this budget.
+    module.deadline = Deadline(module.params['timeout'])
     changed = False
     state = module.params['state']
     resource = module.params['resource']
-    timeout = module.params['timeout']
     check_mode = module.params['check_mode']
     wait_for_resource = module.params['wait_for_resource']
+    cache = StatusCache(module.params['cache_dir'], module.params['cache_ttl'])
 
     if check_mode:
-        if check_resource_state(module, resource, state):
+        timeline = None
+        if module.params['timeline'] or module.params['timeline_file']:
+            timeline = Timeline()
+        labels = dict(module_name='pacemaker_resource', resource=resource,
+                      state=state)
+        probe_start = time.time()
+        found = bool(check_resource_state(module, resource, state,
+                                          cache if cache.ttl > 0 else None))
+        if timeline is not None:
+            timeline.probe(probe_start, True, found)
+        if found:
             module.exit_json(changed=False,
-                             out={'resource': resource, 'status': state})
+                             out={'resource': resource, 'status': state},
+                             **timeline_report(module, timeline, **labels))
         else:
             if wait_for_resource:
-                t = time.time()
                 status = False
-                while time.time() < t+timeout:
-                    if check_resource_state(module, resource, state):
+                while not module.deadline.expired():
+                    probe_start = time.time()
+                    found = bool(check_resource_state(module, resource, state))
+                    if timeline is not None:
+                        timeline.probe(probe_start, True, found)
+                    if found:
                         status = True
                         break
                 if status:
                     module.exit_json(changed=False,
                                      out={'resource': resource,
-                                          'status': state})
+                                          'status': state},
+                                     **timeline_report(module, timeline,
+                                                       **labels))
             module.fail_json(msg="Failed, the resource %s is not %s\n" %
-                             (resource, state))
+                             (resource, state),
+                             **timeline_report(module, timeline, **labels))
 
     # TODO: check state before doing anything:
-    resource_state = get_resource(module, resource)
-    if state == 'delete' and resource_state[0] != 0:
+    # the resource config is only needed to know if a delete is needed.
+    if state == 'delete' and get_resource(module, resource)[0] != 0:
         module.exit_json(changed=False, out={'resource': resource,
                                             'status': 'deleted'})
     else:
-        rc, out, err = set_resource_state(module, resource, state, timeout)
+        rc, out, err = set_resource_state(module, resource, state,
+                                          module.deadline)
+        cache.clear()
         if rc == 1:
             module.fail_json(msg="Failed, to set the resource %s to the state "
                              "%s" % (resource, state),
@@ -0,0 +1,8 @@
+import os
+
+import ansible.module_utils
+
+# The modules import their shared code from ansible.module_utils, where
+# Ansible puts the module_utils directory when it ships them.
+ansible.module_utils.__path__.append(
+    os.path.join(os.path.dirname(__file__), '..', '..', 'module_utils'))
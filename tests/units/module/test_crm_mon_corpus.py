@@ -0,0 +1,271 @@
+from ansible.compat.tests import unittest
+from ansible.compat.tests.mock import create_autospec, patch
+from ansible.module_utils.basic import AnsibleModule
+
+from modules import pacemaker_is_active
+import json
+import os
+import time
+
+CORPUS_DIR = "./tests/units/module/corpus"
+CORPUS = os.path.join(CORPUS_DIR, "expected.json")
+
+# Time budgets, a fixed part in milliseconds plus a part per MB of xml
+# for the parsing, and per checked resource for the checks.  They are
+# about ten times what a laptop needs, so only real regressions (like
+# going back to one XPath query per lookup) make them fail.
+PARSE_BUDGET_MS = (20.0, 200.0)
+CHECK_BUDGET_MS = (20.0, 2.0)
+
+
+def generate_crm_mon(nodes, clones, masters, primitives, bundles):
+    """Generate a crm_mon xml status and its corpus entry.
+
+    All the clones and bundles run on every node, masters are promoted
+    on one node and the odd primitives are stopped.
+
+    """
+    def resource(res_id, role, node=None):
+        active = 'false' if role == 'Stopped' else 'true'
+        line = ('<resource id="{0}" resource_agent="ocf::heartbeat:Dummy" '
+                'role="{1}" active="{2}" orphaned="false" blocked="false" '
+                'managed="true" failed="false" failure_ignored="false" '
+                'nodes_running_on="{3}"'.format(res_id, role, active,
+                                                int(node is not None)))
+        if node is None:
+            return line + ' />'
+        return line + '><node name="{0}" id="{0}" cached="false"/>' \
+            '</resource>'.format(node)
+
+    node_names = ['node-{0}'.format(i) for i in range(nodes)]
+    entry = {'nodes': nodes, 'meta': {}, 'cib': {}, 'resources': {}}
+    xml = ['<?xml version="1.0"?>', '<crm_mon version="2.0.5">',
+           '<summary><current_dc present="true" name="node-0" id="1" '
+           'with_quorum="true"/></summary>', '<nodes>']
+    xml.extend('<node name="{0}" id="{0}" online="true" standby="false" '
+               'type="member"/>'.format(node) for node in node_names)
+    xml.extend(['</nodes>', '<resources>'])
+    for i in range(clones):
+        name = 'clone{0}'.format(i)
+        xml.append('<clone id="{0}-clone" multi_state="false">'.format(name))
+        xml.extend(resource(name, 'Started', node) for node in node_names)
+        xml.append('</clone>')
+        entry['meta'][name] = {'clone-max': str(nodes)}
+        entry['resources'][name] = ['clone', nodes, nodes]
+    for i in range(masters):
+        name = 'master{0}'.format(i)
+        xml.append('<clone id="{0}-master" multi_state="true">'.format(name))
+        xml.extend(resource(name, 'Master' if n == 0 else 'Slave', node)
+                   for n, node in enumerate(node_names))
+        xml.append('</clone>')
+        entry['meta'][name] = {'master-max': '1'}
+        entry['resources'][name] = ['master', 1, 1]
+    for i in range(primitives):
+        name = 'primitive{0}'.format(i)
+        if i % 2:
+            xml.append(resource(name, 'Stopped'))
+        else:
+            xml.append(resource(name, 'Started', node_names[i % nodes]))
+        entry['resources'][name] = ['primitive', 1, 1 - i % 2]
+    for i in range(bundles):
+        name = 'bundle{0}'.format(i)
+        xml.append('<bundle id="{0}-bundle" type="podman">'.format(name))
+        for n, node in enumerate(node_names):
+            xml.append('<replica id="{0}">'.format(n))
+            xml.append(resource(name, 'Started',
+                                '{0}-bundle-{1}'.format(name, n)))
+            xml.append(resource('{0}-bundle-podman-{1}'.format(name, n),
+                                'Started', node))
+            xml.append('</replica>')
+        xml.append('</bundle>')
+        entry['cib']['{0}-bundle'.format(name)] = \
+            '<bundle><podman replicas="{0}"/></bundle>'.format(nodes)
+        entry['resources'][name] = ['bundle', nodes, nodes]
+    xml.extend(['</resources>', '</crm_mon>'])
+    return "\n".join(xml), entry
+
+
+def load_corpus():
+    "Return the (name, xml, entry) of the corpus and the generated ones."
+    with open(CORPUS) as corpus_file:
+        corpus = json.load(corpus_file)
+    fixtures = []
+    for name in sorted(corpus):
+        with open(os.path.join(CORPUS_DIR, name)) as xml_file:
+            fixtures.append((name, xml_file.read(), corpus[name]))
+    fixtures.append(('generated-small',) + generate_crm_mon(2, 1, 1, 1, 1))
+    fixtures.append(('generated-large',) +
+                    generate_crm_mon(32, 60, 20, 500, 20))
+    return fixtures
+
+
+class FakeCluster(object):
+    "Answer the commands run by the module from a corpus entry."
+
+    def __init__(self, xml, entry):
+        self.xml = xml
+        self.entry = entry
+
+    def run_command(self, cmd, *args, **kwargs):
+        if cmd[0] == 'crm_mon':
+            return (0, self.xml, '')
+        if cmd[0] == 'crm_resource':
+            value = self.entry['meta'].get(cmd[2], {}).get(cmd[-1])
+            if value is None:
+                return (6, '', 'Error performing operation: No such device')
+            return (0, value + "\n", '')
+        if cmd[0] == 'cibadmin':
+            bundle_id = cmd[-1].split("'")[1]
+            return (0, self.entry['cib'][bundle_id], '')
+        raise AssertionError("Unexpected command {0}".format(cmd))
+
+    def pipe_no_shell(self, cmd1_array, cmd2_array):
+        if cmd1_array[0] == 'pcs':
+            return ["0\n", None]
+        return ["{0}\n".format(self.entry['nodes']), None]
+
+
+def check_resources(mod, entry):
+    "Return the type, expected and current count of the corpus resources."
+    found = {}
+    for name in entry['resources']:
+        resource = pacemaker_is_active.Resource(mod, name).from_type()
+        if resource.get_type is None:
+            found[name] = [None, None, None]
+            continue
+        found[name] = [resource.get_type,
+                       resource.expected_count(),
+                       resource.current_count()]
+    return found
+
+
+class TestCrmMonCorpus(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = load_corpus()
+
+    def _mod(self, cluster):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.run_command.side_effect = cluster.run_command
+        return mod
+
+    def test__corpus__resources(self):
+        for name, xml, entry in self.fixtures:
+            cluster = FakeCluster(xml, entry)
+            with patch('modules.pacemaker_is_active.Clone._pipe_no_shell',
+                       side_effect=cluster.pipe_no_shell):
+                found = check_resources(self._mod(cluster), entry)
+            for resource_name, expected in entry['resources'].items():
+                self.assertEqual(
+                    found[resource_name], expected,
+                    "{0}: {1} is {2} instead of {3}".format(
+                        name, resource_name, found[resource_name], expected))
+
+    def test__corpus__parse_time(self):
+        for name, xml, entry in self.fixtures:
+            size_mb = len(xml) / (1024.0 * 1024.0)
+            budget = PARSE_BUDGET_MS[0] + PARSE_BUDGET_MS[1] * size_mb
+            elapsed = []
+            for _ in range(3):
+                start = time.time()
+                status = pacemaker_is_active.Status(xml)
+                elapsed.append((time.time() - start) * 1000)
+            self.assertTrue(status.index)
+            self.assertLessEqual(
+                min(elapsed), budget,
+                "{0}: parsing took {1:.1f}ms, budget is {2:.1f}ms".format(
+                    name, min(elapsed), budget))
+
+    def test__corpus__check_time(self):
+        for name, xml, entry in self.fixtures:
+            cluster = FakeCluster(xml, entry)
+            mod = self._mod(cluster)
+            budget = (CHECK_BUDGET_MS[0] +
+                      CHECK_BUDGET_MS[1] * len(entry['resources']))
+            with patch('modules.pacemaker_is_active.Clone._pipe_no_shell',
+                       side_effect=cluster.pipe_no_shell):
+                # The first check pays for the parsing.
+                check_resources(mod, entry)
+                start = time.time()
+                check_resources(mod, entry)
+                elapsed = (time.time() - start) * 1000
+            self.assertLessEqual(
+                elapsed, budget,
+                "{0}: checks took {1:.1f}ms, budget is {2:.1f}ms".format(
+                    name, elapsed, budget))
+
+
+class TestFleet(unittest.TestCase):
+    # The fleet counts a group member with its group.
+    GROUPED = ('cluster_bundle.xml',)
+    # The clones the snapshot places with the "$resourcename-role" node
+    # attributes, which the live check does not read.
+    ROLE_COUNTS = {('cluster_good.xml', 'haproxy'): [3, 3],
+                   ('cluster_good.xml', 'haproxy-clone'): [3, 3]}
+
+    def setUp(self):
+        self.fixtures = [fixture for fixture in load_corpus()
+                         if fixture[0] not in self.GROUPED]
+
+    def _fleet(self, fixtures):
+        fleet = pacemaker_is_active.Fleet()
+        for name, xml, entry in fixtures:
+            fleet.add(name, xml)
+        return fleet
+
+    def _check_corpus(self):
+        fleet = self._fleet(self.fixtures)
+        for row, (name, xml, entry) in enumerate(self.fixtures):
+            names = [resource_name for resource_name in entry['resources']
+                     if fleet.column(resource_name) is not None]
+            self.assertTrue(names)
+            readiness = fleet.readiness(names=names)
+            for col, resource_name in enumerate(names):
+                found = [readiness['expected'][row][col],
+                         readiness['current'][row][col]]
+                if found[0] is None:
+                    # The promoted count of a master is in the cib only.
+                    self.assertEqual(found[1],
+                                     entry['resources'][resource_name][2])
+                    self.assertEqual(readiness['ready'][row][col],
+                                     found[1] > 0)
+                    continue
+                counts = self.ROLE_COUNTS.get(
+                    (name, resource_name),
+                    entry['resources'][resource_name][1:])
+                self.assertEqual(
+                    found, counts,
+                    "{0}: {1} is {2} instead of {3}".format(
+                        name, resource_name, found, counts))
+                self.assertEqual(readiness['ready'][row][col],
+                                 found[0] == found[1])
+        return fleet.readiness()
+
+    def test__fleet__corpus(self):
+        self._check_corpus()
+
+    def test__fleet__without_numpy(self):
+        with_numpy = self._check_corpus()
+        with patch('modules.pacemaker_is_active.numpy', None):
+            self.assertEqual(self._check_corpus(), with_numpy)
+
+    def test__fleet__expected_counts(self):
+        fixtures = [fixture for fixture in load_corpus()
+                    if fixture[0] == 'cluster_good.xml']
+        readiness = self._fleet(fixtures).readiness(
+            expected={'galera': 3},
+            names=['galera', 'haproxy', 'rabbitmq', 'blhaaa'])
+        # haproxy and rabbitmq only run on the nodes with their role.
+        self.assertEqual(readiness['expected'], [[3, 3, 3, 0]])
+        self.assertEqual(readiness['current'], [[3, 3, 3, 0]])
+        self.assertEqual(readiness['ready'], [[True, True, True, False]])
+
+    def test__fleet__masters(self):
+        fixtures = [fixture for fixture in load_corpus()
+                    if fixture[0] == 'cluster_good.xml']
+        readiness = self._fleet(fixtures).readiness(
+            names=['galera', 'redis'])
+        # The promoted count is in the cib, one promoted instance is enough.
+        self.assertEqual(readiness['expected'], [[None, None]])
+        self.assertEqual(readiness['current'], [[3, 1]])
+        self.assertEqual(readiness['ready'], [[True, True]])
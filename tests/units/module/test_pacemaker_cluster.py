@@ -0,0 +1,327 @@
+import tempfile
+
+from ansible.compat.tests import unittest
+from ansible.compat.tests.mock import create_autospec, patch
+from ansible.module_utils.basic import AnsibleModule
+
+from modules import pacemaker_cluster
+
+FAILED_CIB = "./tests/units/module/corpus/crm_mon_2.1_failed.xml"
+GOOD_CIB = "./tests/units/module/corpus/cluster_good.xml"
+STANDBY_CIB = "./tests/units/module/corpus/crm_mon_2.0_standby.xml"
+
+
+class MyTestUtils(object):
+    @staticmethod
+    def cib_file_to_string(file_path):
+        xml_string = ''
+        with open(file_path, "r") as myfile:
+            xml_string = myfile.read()
+        return xml_string
+
+
+class TestCleanup(unittest.TestCase):
+    def _mod(self, cib):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.run_command.return_value = (0,
+                                        MyTestUtils.cib_file_to_string(cib),
+                                        '')
+        return mod
+
+    def test__get_failures__failed(self):
+        mod = self._mod(FAILED_CIB)
+        self.assertEqual(pacemaker_cluster.get_failures(mod), [
+            ('haproxy', 'controller-1'),
+            ('openstack-cinder-volume', 'controller-1'),
+        ])
+        self.assertEqual(pacemaker_cluster.get_failures(mod, 'controller-0'),
+                         [])
+
+    def test__get_failures__failcounts(self):
+        mod = self._mod(GOOD_CIB)
+        self.assertEqual(pacemaker_cluster.get_failures(mod), [
+            ('galera', 'controller-galera-1'),
+            ('rabbitmq', 'controller-rabbit-0'),
+        ])
+
+    def test__get_failures__clean(self):
+        mod = self._mod(STANDBY_CIB)
+        self.assertEqual(pacemaker_cluster.get_failures(mod), [])
+
+    def test__get_failures__migrate(self):
+        mod = self._mod(STANDBY_CIB)
+        mod.run_command.return_value = (0, (
+            '<crm_mon><failures>'
+            '<failure op_key="ip-10.0.0.101_migrate_to_0" node="ctl-0" '
+            'interval="0" task="migrate_to"/>'
+            '<failure op_key="my_rsc_migrate_from_0" node="ctl-1" '
+            'interval="0ms" task="migrate_from"/>'
+            '</failures></crm_mon>'), '')
+        self.assertEqual(pacemaker_cluster.get_failures(mod), [
+            ('ip-10.0.0.101', 'ctl-0'),
+            ('my_rsc', 'ctl-1'),
+        ])
+
+    def _runner(self, deadline):
+        mod = pacemaker_cluster.CommandRunner(self._mod(FAILED_CIB),
+                                              deadline)
+        mod.module.get_bin_path.return_value = 'crm_resource'
+        return mod
+
+    @patch('ansible.module_utils.pacemaker.subprocess.Popen')
+    def test__clean_cluster__batches(self, popen):
+        mod = self._runner(pacemaker_cluster.Deadline(60))
+        popen.return_value.communicate.return_value = (b'', b'')
+        popen.return_value.returncode = 0
+        targets = [('rsc{0}'.format(i), 'controller-{0}'.format(i % 3))
+                   for i in range(5)]
+        pacemaker_cluster.clean_cluster(mod, mod.deadline, targets, 2)
+        self.assertEqual(
+            [call[0][0] for call in popen.call_args_list],
+            [['timeout', '-k', '5', '60',
+              'crm_resource', '--cleanup', '-r', rsc, '-N', node]
+             for rsc, node in targets])
+        # a single wait for the whole cleanup
+        mod.module.run_command.assert_called_once_with(
+            ['timeout', '-k', '5', '60',
+             'crm_resource', '--wait', '--timeout', '60s'])
+        self.assertEqual(mod.report()['commands'], 6)
+        self.assertEqual(0, mod.module.fail_json.call_count)
+
+    @patch('ansible.module_utils.pacemaker.subprocess.Popen')
+    def test__clean_cluster__errors(self, popen):
+        mod = self._runner(pacemaker_cluster.Deadline(60))
+        popen.return_value.communicate.return_value = (
+            b'', b'Error performing operation: No such device\n')
+        popen.return_value.returncode = 6
+        pacemaker_cluster.clean_cluster(mod, mod.deadline, [('rsc', 'n1')])
+        self.assertIn("`crm_resource --cleanup -r rsc -N n1`: "
+                      "Error performing operation: No such device",
+                      mod.module.fail_json.call_args_list[0][1]['msg'])
+
+    @patch('ansible.module_utils.pacemaker.subprocess.Popen')
+    def test__clean_cluster__missing_binary(self, popen):
+        mod = self._runner(pacemaker_cluster.Deadline(60))
+        popen.side_effect = OSError(2, 'No such file or directory')
+        pacemaker_cluster.clean_cluster(mod, mod.deadline, [('rsc', 'n1')])
+        self.assertEqual(mod.module.fail_json.call_args_list[0][1]['rc'], 2)
+
+    @patch('ansible.module_utils.pacemaker.subprocess.Popen')
+    def test__clean_cluster__killed(self, popen):
+        mod = self._runner(pacemaker_cluster.Deadline(60))
+
+        def communicate():
+            mod.deadline.end = 0
+            return (b'', b'')
+        popen.return_value.communicate.side_effect = communicate
+        popen.return_value.returncode = 124
+        pacemaker_cluster.clean_cluster(mod, mod.deadline, [('rsc', 'n1')])
+        self.assertIn("`crm_resource --cleanup -r rsc -N n1` was stopped",
+                      mod.module.fail_json.call_args_list[0][1]['msg'])
+
+
+def nodes_xml(**online):
+    return ('<crm_mon><summary><current_dc present="true" '
+            'with_quorum="true"/></summary><nodes>%s</nodes></crm_mon>' %
+            ''.join('<node name="%s" online="%s" type="member"/>' %
+                    (name.replace('_', '-'), str(state).lower())
+                    for name, state in sorted(online.items())))
+
+
+@patch('modules.pacemaker_cluster.time.sleep')
+class TestSetNode(unittest.TestCase):
+    def _mod(self):
+        mod_cls = create_autospec(AnsibleModule)
+        return pacemaker_cluster.CommandRunner(mod_cls.return_value)
+
+    def test__set_node__batch(self, sleep):
+        mod = self._mod()
+        mod.module.run_command.side_effect = [
+            (0, nodes_xml(controller_0=False, controller_1=False,
+                          controller_2=True), ''),
+            (0, '', ''),
+            (0, nodes_xml(controller_0=True, controller_1=False,
+                          controller_2=True), ''),
+            (0, nodes_xml(controller_0=True, controller_1=True,
+                          controller_2=True), ''),
+        ]
+        pacemaker_cluster.set_node(mod, 'online',
+                                   pacemaker_cluster.Deadline(10), True)
+        self.assertEqual(
+            mod.module.run_command.call_args_list[1][0][0],
+            "pcs cluster start controller-0 controller-1")
+        self.assertEqual(mod.report(),
+                         {'commands': 4, 'saved_round_trips': 1})
+        self.assertEqual(2, sleep.call_count)
+        self.assertEqual(0, mod.module.fail_json.call_count)
+
+    def test__set_node__stop(self, sleep):
+        # pcsd answering does not make the node a cluster member
+        mod = self._mod()
+        mod.module.run_command.side_effect = [
+            (0, nodes_xml(controller_0=True, controller_1=True), ''),
+            (0, '', ''),
+            (0, nodes_xml(controller_0=True, controller_1=False), ''),
+        ]
+        pacemaker_cluster.set_node(mod, 'offline',
+                                   pacemaker_cluster.Deadline(10), False,
+                                   'controller-1')
+        self.assertEqual(
+            mod.module.run_command.call_args_list[1][0][0],
+            "pcs cluster stop controller-1")
+        self.assertEqual(0, mod.module.fail_json.call_count)
+
+    @patch('modules.pacemaker_cluster.os.uname')
+    @patch('modules.pacemaker_cluster.corosync_nodes')
+    def test__get_node_states__local_offline(self, nodes, uname, sleep):
+        mod = self._mod()
+        nodes.return_value = ['controller-0', 'controller-1']
+        uname.return_value = ('Linux', 'controller-0.localdomain')
+        mod.module.run_command.return_value = (102, '', 'not connected')
+        self.assertEqual(pacemaker_cluster.get_node_states(mod), [
+            ['controller-0', 'offline'],
+            ['controller-1', 'unknown'],
+        ])
+        self.assertEqual(
+            pacemaker_cluster.get_node_states(mod, 'controller-0'),
+            [['controller-0', 'offline']])
+
+    def test__corosync_nodes(self, sleep):
+        conf = tempfile.NamedTemporaryFile(mode='w', suffix='.conf')
+        conf.write("totem {\n    version: 2\n}\n"
+                   "nodelist {\n"
+                   "    node {\n        ring0_addr: controller-0\n"
+                   "        nodeid: 1\n    }\n"
+                   "    node {\n        ring0_addr: 172.17.1.11\n"
+                   "        name: controller-1\n    }\n"
+                   "}\n")
+        conf.flush()
+        self.assertEqual(pacemaker_cluster.corosync_nodes(conf.name),
+                         ['controller-0', 'controller-1'])
+        conf.close()
+        self.assertEqual(pacemaker_cluster.corosync_nodes(conf.name), [])
+
+
+class TestDeadline(unittest.TestCase):
+    def _mod(self, deadline):
+        mod_cls = create_autospec(AnsibleModule)
+        return pacemaker_cluster.CommandRunner(mod_cls.return_value, deadline)
+
+    def test__deadline__wrap(self):
+        deadline = pacemaker_cluster.Deadline(30)
+        self.assertEqual(deadline.wrap(['crm_mon', '--as-xml']),
+                         ['timeout', '-k', '5', '30', 'crm_mon', '--as-xml'])
+        self.assertEqual(deadline.wrap("pcs cluster stop"),
+                         "timeout -k 5 30 pcs cluster stop")
+
+    def test__deadline__expired(self):
+        deadline = pacemaker_cluster.Deadline(0)
+        self.assertTrue(deadline.expired())
+        self.assertEqual(deadline.remaining(), 0)
+        # the tools always get some time to answer
+        self.assertEqual(deadline.seconds(), 1)
+
+    def test__set_cluster__leftover_budget(self):
+        # the stop used the whole budget, the start is not launched
+        mod = self._mod(pacemaker_cluster.Deadline(0))
+        mod.module.run_command.return_value = (0, '', '')
+        pacemaker_cluster.set_cluster(mod, 'online', mod.deadline, True)
+        self.assertEqual(0, mod.module.run_command.call_count)
+        self.assertIn("before `pcs cluster start` could run",
+                      mod.module.fail_json.call_args_list[0][1]['msg'])
+
+    @patch('modules.pacemaker_cluster.time.sleep')
+    @patch('modules.pacemaker_cluster.get_cluster_status')
+    def test__set_cluster__poll(self, get_cluster_status, sleep):
+        mod = self._mod(pacemaker_cluster.Deadline(60))
+        mod.module.run_command.return_value = (0, '', '')
+        get_cluster_status.side_effect = ['offline', 'partial', 'online']
+        timeline = pacemaker_cluster.Timeline()
+        pacemaker_cluster.set_cluster(mod, 'online', mod.deadline, False,
+                                      timeline)
+        # one probe per second at most
+        self.assertEqual(2, sleep.call_count)
+        self.assertTrue(all(0 < call[0][0] <= 1
+                            for call in sleep.call_args_list))
+        self.assertEqual(timeline.result()['current'],
+                         ['offline', 'partial', 'online'])
+        self.assertEqual(0, mod.module.fail_json.call_count)
+
+    def test__run_command__killed(self):
+        mod = self._mod(pacemaker_cluster.Deadline(60))
+
+        def run_command(cmd, *args, **kwargs):
+            mod.deadline.end = 0
+            return (124, '', '')
+        mod.module.run_command.side_effect = run_command
+        mod.run_command("pcs cluster status")
+        self.assertEqual(1, mod.module.fail_json.call_count)
+        self.assertIn("`pcs cluster status` was stopped",
+                      mod.module.fail_json.call_args[1]['msg'])
+
+    def test__run_command__in_time(self):
+        mod = self._mod(pacemaker_cluster.Deadline(60))
+        mod.module.run_command.return_value = (124, '', '')
+        self.assertEqual(mod.run_command("pcs cluster status"), (124, '', ''))
+        self.assertEqual(0, mod.module.fail_json.call_count)
+
+
+class TestClusterStatus(unittest.TestCase):
+    def setUp(self):
+        pacemaker_cluster._LOCAL_NODE.clear()
+        patcher = patch('modules.pacemaker_cluster.os.uname',
+                        return_value=('Linux', 'controller-1.localdomain',
+                                      '', '', 'x86_64'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _status(self, cib, *replacements, **kwargs):
+        xml = MyTestUtils.cib_file_to_string(cib)
+        for old, new in replacements:
+            xml = xml.replace(old, new, 1)
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.run_command.return_value = (kwargs.get('rc', 0), xml, '')
+        return pacemaker_cluster.get_cluster_status(mod), mod
+
+    def test__cluster_status__online(self):
+        state, mod = self._status(FAILED_CIB)
+        self.assertEqual(state, 'online')
+        # a single crm_mon, no crm_node nor pcs
+        mod.run_command.assert_called_once_with(['crm_mon', '--as-xml'])
+
+    def test__cluster_status__no_quorum(self):
+        state, mod = self._status(
+            FAILED_CIB, ('with_quorum="true"', 'with_quorum="false"'))
+        self.assertEqual(state, 'no-quorum')
+
+    def test__cluster_status__partial(self):
+        state, mod = self._status(
+            FAILED_CIB, ('name="controller-1" id="2" online="true"',
+                         'name="controller-1" id="2" online="false"'))
+        self.assertEqual(state, 'partial')
+        state, mod = self._status(FAILED_CIB,
+                                  ('present="true"', 'present="false"'))
+        self.assertEqual(state, 'partial')
+
+    def test__cluster_status__offline(self):
+        state, mod = self._status(FAILED_CIB, rc=102)
+        self.assertEqual(state, 'offline')
+
+    @patch('modules.pacemaker_cluster.os.uname',
+           return_value=('Linux', 'overcloud-ctl-2', '', '', 'x86_64'))
+    def test__cluster_status__node_name(self, uname):
+        # the host name is not a node name, crm_node tells which it is
+        xml = MyTestUtils.cib_file_to_string(STANDBY_CIB)
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.run_command.side_effect = [(0, xml, ''),
+                                       (0, "controller-2\n", ''),
+                                       (0, xml, '')]
+        for _ in range(2):
+            self.assertEqual(pacemaker_cluster.get_cluster_status(mod),
+                             'online')
+        self.assertEqual(mod.run_command.call_args_list[1][0][0],
+                         "crm_node -n")
+        self.assertEqual(mod.run_command.call_count, 3)
@@ -2,11 +2,16 @@ from ansible.compat.tests import unittest
 from ansible.compat.tests.mock import call, create_autospec, patch
 from ansible.module_utils.basic import AnsibleModule
 
+from lxml import etree
 from modules import pacemaker_is_active
 import subprocess
 import json
+import shutil
+import tempfile
 
-GOOD_CIB = "./tests/units/module/cluster_good.xml"
+GOOD_CIB = "./tests/units/module/corpus/cluster_good.xml"
+BUNDLE_CIB = "./tests/units/module/corpus/cluster_bundle.xml"
+GOOD_CONSTRAINTS = "./tests/units/module/corpus/constraints_good.xml"
 
 
 class MyTestUtils(object):
@@ -223,3 +228,460 @@ class TestTimeout(unittest.TestCase):
         pacemaker_is_active.is_resource_active(mod)
         self.assertEqual(1, mod.fail_json.call_count)
         self.assertEqual(0, mod.exit_json.call_count)
+
+    @patch('modules.pacemaker_is_active.Primitive.current_count')
+    @patch('modules.pacemaker_is_active.Primitive.expected_count')
+    @patch('modules.pacemaker_is_active.Resource.from_type')
+    def test__primitive_resource__deadline(self, has_type, expected_count,
+                                           current_count):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(resource="openstack-cinder-volume", max_wait="3")
+        has_type.return_value = pacemaker_is_active.Primitive(
+            mod, 'openstack-cinder-volume')
+        expected_count.return_value = 1
+        current_count.return_value = 0
+        # the commands used the budget, no more tries
+        pacemaker_is_active.is_resource_active(
+            mod, pacemaker_is_active.Deadline(0))
+        self.assertEqual(1, current_count.call_count)
+        self.assertEqual(1, mod.fail_json.call_count)
+
+    @patch('modules.pacemaker_is_active.AnsibleModule')
+    def test__main__max_wait_zero(self, module):
+        # max_wait: 0 checks the resource once, like it always did
+        module.return_value.params = dict(
+            resource="openstack-cinder-volume", max_wait=0, cache_ttl=0,
+            with_dependencies=False, timeline=False, timeline_file=None,
+            watch=False, resources=None, snapshots=None, profile='none')
+        module.return_value.run_command.return_value = (
+            0, MyTestUtils.cib_file_to_string(GOOD_CIB), '')
+        pacemaker_is_active.main()
+        self.assertEqual(0, module.return_value.fail_json.call_count)
+        self.assertEqual(1, module.return_value.exit_json.call_count)
+        self.assertEqual(
+            module.return_value.run_command.call_args_list[0][0][0],
+            ['timeout', '-k', '5', '30', 'crm_mon', '-r', '--as-xml'])
+
+    def test__pipe_no_shell__deadline(self):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = pacemaker_is_active.CommandRunner(
+            mod_cls.return_value, pacemaker_is_active.Deadline(30))
+        mod.module.run_command.side_effect = [
+            (0, "1 node-0 member\n2 node-1 member\n", ''), (0, "2\n", '')]
+        clone = pacemaker_is_active.Clone(mod, 'haproxy')
+        self.assertEqual(
+            clone._pipe_no_shell(['crm_node', '-l'], ['wc', '-l']),
+            ["2\n", ''])
+        self.assertEqual(mod.module.run_command.call_args_list[1][0][0],
+                         ['timeout', '-k', '5', '30', 'wc', '-l'])
+        self.assertEqual(mod.module.run_command.call_args_list[1][1],
+                         {'data': "1 node-0 member\n2 node-1 member\n",
+                          'binary_data': True})
+
+
+class TestStatusCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    @patch('modules.pacemaker_is_active.AnsibleModule.run_command')
+    @patch('modules.pacemaker_is_active.AnsibleModule')
+    def test__status_cache__reused_across_resources(self, mod, run_command):
+        mod.run_command.return_value = (
+            0, MyTestUtils.cib_file_to_string(GOOD_CIB), '')
+        cache = pacemaker_is_active.StatusCache(self.cache_dir, 5)
+        for resource_name in ['haproxy', 'galera', 'redis']:
+            pacemaker_is_active.Resource(
+                mod,
+                resource_name,
+                cache
+            ).from_type().current_count()
+        self.assertEqual(1, mod.run_command.call_count)
+
+
+class TestDependencies(unittest.TestCase):
+    @staticmethod
+    def run_command(cmd, *args, **kwargs):
+        if cmd[0] == 'cibadmin':
+            return (0, MyTestUtils.cib_file_to_string(GOOD_CONSTRAINTS), '')
+        return (0, MyTestUtils.cib_file_to_string(GOOD_CIB), '')
+
+    def test__dependency_graph__happy_path(self):
+        constraints = etree.fromstring(
+            MyTestUtils.cib_file_to_string(GOOD_CONSTRAINTS))
+        status = pacemaker_is_active.Status(
+            MyTestUtils.cib_file_to_string(GOOD_CIB))
+        graph = pacemaker_is_active.dependency_graph(
+            constraints,
+            pacemaker_is_active.resource_names(status))
+        self.assertEqual(graph, {
+            'ip-192.168.24.10': set(['haproxy']),
+            'ip-172.17.1.14': set(['haproxy']),
+            'openstack-cinder-volume': set(['haproxy', 'galera']),
+            'redis': set(['ip-172.17.1.13']),
+        })
+        self.assertEqual(
+            pacemaker_is_active.dependency_closure(
+                graph, 'openstack-cinder-volume'),
+            set(['openstack-cinder-volume', 'haproxy', 'galera']))
+
+    @patch('modules.pacemaker_is_active.Master.expected_count')
+    @patch('modules.pacemaker_is_active.Clone.expected_count')
+    def test__dependencies__happy(self, clone_expected_count,
+                                  master_expected_count):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(
+            resource="openstack-cinder-volume",
+            max_wait="5",
+            with_dependencies=True,
+        )
+        mod.run_command.side_effect = self.run_command
+        clone_expected_count.return_value = 3
+        master_expected_count.return_value = 3
+        pacemaker_is_active.is_resource_active(mod)
+        self.assertEqual(0, mod.fail_json.call_count)
+        self.assertEqual(1, mod.exit_json.call_count)
+        result = mod.exit_json.call_args[1]
+        self.assertEqual(sorted(result['dependencies']),
+                         ['galera', 'haproxy', 'openstack-cinder-volume'])
+        self.assertEqual(
+            [step['resource'] for step in result['critical_path']][-1],
+            'openstack-cinder-volume')
+        # one crm_mon for the whole closure and one cibadmin
+        self.assertEqual(2, mod.run_command.call_count)
+
+    def test__topological_order(self):
+        graph = {'a': set(['b', 'c']), 'b': set(['c']), 'c': set(),
+                 'd': set(['e']), 'e': set(['d'])}
+        self.assertEqual(
+            pacemaker_is_active.topological_order(graph, set(graph)),
+            ['c', 'b', 'a', 'e', 'd'])
+
+    @patch('modules.pacemaker_is_active.Master.expected_count')
+    def test__dependencies__clone_id(self, master_expected_count):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(
+            resource="redis-master",
+            max_wait="5",
+            with_dependencies=True,
+        )
+        mod.run_command.side_effect = self.run_command
+        master_expected_count.return_value = 1
+        pacemaker_is_active.is_resource_active(mod)
+        self.assertEqual(0, mod.fail_json.call_count)
+        result = mod.exit_json.call_args[1]
+        self.assertEqual(sorted(result['dependencies']),
+                         ['ip-172.17.1.13', 'redis'])
+        self.assertEqual(
+            [step['resource'] for step in result['critical_path']],
+            ['ip-172.17.1.13', 'redis'])
+
+    @patch('modules.pacemaker_is_active.sleep')
+    @patch('modules.pacemaker_is_active.Clone.expected_count')
+    def test__dependencies__timeout(self, clone_expected_count, sleep):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(
+            resource="ip-192.168.24.10",
+            max_wait="3",
+            with_dependencies=True,
+        )
+        mod.run_command.side_effect = self.run_command
+        clone_expected_count.return_value = 3
+        pacemaker_is_active.is_resource_active(mod)
+        self.assertEqual(1, mod.fail_json.call_count)
+        self.assertEqual(0, mod.exit_json.call_count)
+        self.assertEqual(list(mod.fail_json.call_args[1]['dependencies']),
+                         ['haproxy'])
+
+
+class TestBundleResource(unittest.TestCase):
+    @patch('modules.pacemaker_is_active.AnsibleModule.run_command')
+    @patch('modules.pacemaker_is_active.AnsibleModule')
+    def test__resource_type_of__bundle(self, mod, run_command):
+        run_command.return_value = (0,
+                                    MyTestUtils.cib_file_to_string(BUNDLE_CIB),
+                                    '')
+
+        expected_result = {
+            'galera': ('bundle', 'galera', 2),
+            'galera-bundle': ('bundle', 'galera', 2),
+            'rabbitmq': ('bundle', 'rabbitmq', 2),
+            'haproxy': ('bundle', 'haproxy-bundle', 3),
+            'cinder-group': ('group', 'cinder-group', 1),
+            'openstack-cinder-volume': ('primitive',
+                                        'openstack-cinder-volume', 0),
+            'compute-0': ('primitive', 'compute-0', 1),
+            'galera-bundle-docker-0': ('primitive',
+                                       'galera-bundle-docker-0', 1),
+            'galera-bundle-d': (None, 'galera-bundle-d', None),
+        }
+
+        for resource_name, expected in expected_result.items():
+            resource = pacemaker_is_active.Resource(
+                mod,
+                resource_name
+            ).from_type()
+            current = None
+            if resource.get_type is not None:
+                current = resource.current_count()
+            self.assertEqual((resource.get_type, resource.name, current),
+                             expected)
+
+    @patch('modules.pacemaker_is_active.AnsibleModule.run_command')
+    @patch('modules.pacemaker_is_active.AnsibleModule')
+    def test__bundle__expected_count(self, mod, run_command):
+        bundle_cib = MyTestUtils.cib_file_to_string(BUNDLE_CIB)
+        run_command.side_effect = [
+            (0, bundle_cib, ''),
+            (0, '<bundle id="galera-bundle"><docker masters="3" '
+                'replicas="3"/><network/></bundle>', ''),
+            (0, bundle_cib, ''),
+            (0, '<bundle id="rabbitmq-bundle"><docker replicas="3"/>'
+                '</bundle>', ''),
+        ]
+        galera = pacemaker_is_active.Bundle(mod, 'galera')
+        self.assertEqual(galera.expected_count(), 3)
+        self.assertEqual(galera.role, 'Master')
+        rabbitmq = pacemaker_is_active.Bundle(mod, 'rabbitmq')
+        self.assertEqual(rabbitmq.expected_count(), 3)
+        self.assertEqual(rabbitmq.role, 'Started')
+
+    @patch('modules.pacemaker_is_active.AnsibleModule.run_command')
+    @patch('modules.pacemaker_is_active.AnsibleModule')
+    def test__bundle__containers(self, mod, run_command):
+        # the ip of each replica comes first, only its container counts
+        replica = ('<replica id="{0}">'
+                   '<resource id="haproxy-bundle-ip-10.0.0.{0}" '
+                   'role="Started" active="true" failed="false"/>'
+                   '<resource id="haproxy-bundle-podman-{0}" role="{1}" '
+                   'active="{2}" failed="false"/></replica>')
+        status = ('<crm_mon><resources><bundle id="haproxy-bundle">' +
+                  replica.format(0, 'Started', 'true') +
+                  replica.format(1, 'Stopped', 'false') +
+                  '</bundle></resources></crm_mon>')
+        run_command.return_value = (0, status, '')
+        resource = pacemaker_is_active.Resource(mod, 'haproxy').from_type()
+        self.assertEqual(resource.current_count(), 1)
+        fleet = pacemaker_is_active.Fleet()
+        fleet.add('status', status)
+        readiness = fleet.readiness(names=['haproxy'])
+        self.assertEqual(readiness['expected'], [[2]])
+        self.assertEqual(readiness['current'], [[1]])
+
+
+class TestGroupResource(unittest.TestCase):
+    @patch('modules.pacemaker_is_active.AnsibleModule.run_command')
+    @patch('modules.pacemaker_is_active.AnsibleModule')
+    def test__group__cloned(self, mod, run_command):
+        member = ('<resource id="{0}:{1}" role="{2}" active="{3}" '
+                  'failed="false"/>')
+        group = '<group id="g:{0}">{1}{2}</group>'
+        run_command.return_value = (0, (
+            '<crm_mon><resources><clone id="g-clone" multi_state="false">' +
+            group.format(0, member.format('a', 0, 'Started', 'true'),
+                         member.format('b', 0, 'Started', 'true')) +
+            group.format(1, member.format('a', 1, 'Started', 'true'),
+                         member.format('b', 1, 'Stopped', 'false')) +
+            '</clone></resources></crm_mon>'), '')
+        resource = pacemaker_is_active.Group(mod, 'g')
+        self.assertEqual(resource.expected_count(), 4)
+        self.assertEqual(resource.current_count(), 3)
+        for name in ('g', 'g-clone'):
+            resource = pacemaker_is_active.Resource(mod, name).from_type()
+            self.assertEqual((resource.get_type, resource.name),
+                             ('group', 'g'))
+            self.assertEqual(resource.current_count(), 3)
+
+
+class TestTimeline(unittest.TestCase):
+    def test__timeline__summary(self):
+        timeline = pacemaker_is_active.Timeline()
+        for current, duration in [(1, 0.4), (2, 0.1), (3, 0.2), (3, 0.3)]:
+            timeline.probe(timeline.start - duration, 3, current)
+        self.assertEqual(timeline.expected, [3, 3, 3, 3])
+        self.assertEqual(timeline.current, [1, 2, 3, 3])
+        summary = timeline.summary()
+        self.assertEqual(summary['probes'], 4)
+        self.assertEqual(summary['converged_after'], timeline.times[2])
+        self.assertEqual(summary['probe_time']['p50'], timeline.durations[2])
+        self.assertEqual(summary['probe_time']['p100'], timeline.durations[0])
+
+    @patch('modules.pacemaker_is_active.sleep')
+    @patch('modules.pacemaker_is_active.Primitive.current_count')
+    @patch('modules.pacemaker_is_active.Resource.from_type')
+    def test__timeline__is_resource_active(self, has_type,
+                                           primitive_resource_current_count,
+                                           sleep):
+        timeline_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, timeline_dir)
+        timeline_file = timeline_dir + '/timeline.jsonl'
+
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(
+            resource="openstack-cinder-volume",
+            max_wait="5",
+            timeline=True,
+            timeline_file=timeline_file,
+        )
+
+        has_type.return_value = pacemaker_is_active.Primitive(
+            mod,
+            "openstack-cinder-volume")
+        primitive_resource_current_count.side_effect = [0, 0, 1]
+        for _ in range(2):
+            pacemaker_is_active.is_resource_active(mod)
+            primitive_resource_current_count.side_effect = [1]
+        self.assertEqual(2, mod.exit_json.call_count)
+        timeline = mod.exit_json.call_args_list[0][1]['timeline']
+        self.assertEqual(timeline['expected'], [1, 1, 1])
+        self.assertEqual(timeline['current'], [0, 0, 1])
+        self.assertEqual(timeline['summary']['probes'], 3)
+        with open(timeline_file) as lines:
+            entries = [json.loads(line) for line in lines]
+        self.assertEqual([entry['current'] for entry in entries],
+                         [[0, 0, 1], [1]])
+        self.assertEqual(entries[0]['resource'], 'openstack-cinder-volume')
+
+
+class TestStatus(unittest.TestCase):
+    def test__status__records(self):
+        status = pacemaker_is_active.Status(
+            MyTestUtils.cib_file_to_string(BUNDLE_CIB))
+        galera = status.index['galera']
+        self.assertEqual([res.role for res in galera],
+                         ['Master', 'Master', 'Slave'])
+        self.assertIs(galera[0].role, galera[1].role)
+        self.assertEqual(galera[0].nodes, ('galera-bundle-0',))
+        self.assertEqual(galera[0].parent.parent.id, 'galera-bundle')
+        self.assertFalse(hasattr(galera[0], '__dict__'))
+        self.assertEqual([res.id for res in status.resources],
+                         ['galera-bundle', 'rabbitmq-bundle',
+                          'haproxy-bundle', 'cinder-group', 'compute-0',
+                          'ip-192.168.24.10'])
+
+
+class TestWatch(unittest.TestCase):
+    @patch('modules.pacemaker_is_active.sleep')
+    @patch('modules.pacemaker_is_active.time.time')
+    @patch('modules.pacemaker_is_active.Clone.expected_count')
+    def test__watch__events(self, clone_expected_count, now, sleep):
+        good = MyTestUtils.cib_file_to_string(GOOD_CIB)
+        degraded = good.replace(
+            'resource_agent="systemd:haproxy" role="Started" active="true" '
+            'orphaned="false" managed="true" failed="false"',
+            'resource_agent="systemd:haproxy" role="Started" active="true" '
+            'orphaned="false" managed="true" failed="true"', 1)
+        outputs = [good, good, good, degraded, degraded, good, good]
+        clock = [1000.0]
+        now.side_effect = lambda: clock[0]
+
+        def tick(interval):
+            clock[0] += interval
+        sleep.side_effect = tick
+
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(
+            resource=None,
+            resources=['haproxy', 'openstack-cinder-volume'],
+            watch=True,
+            watch_duration=10,
+            watch_interval=2,
+        )
+        mod.run_command.side_effect = lambda *args: (0, outputs.pop(0), '')
+        clone_expected_count.return_value = 3
+        pacemaker_is_active.watch_resources(mod)
+        self.assertEqual(0, mod.fail_json.call_count)
+        events = mod.exit_json.call_args[1]['events']
+        self.assertEqual(
+            [(event['resource'], event['active'], event['current'])
+             for event in events],
+            [('haproxy', True, 3), ('openstack-cinder-volume', True, 1),
+             ('haproxy', False, 2), ('haproxy', True, 3)])
+        self.assertEqual(outputs, [])
+
+        # Only the last events are returned.
+        outputs.extend([good, good, good, degraded, degraded, good, good])
+        clock[0] = 1000.0
+        with patch('modules.pacemaker_is_active.WATCH_EVENTS', 2):
+            pacemaker_is_active.watch_resources(mod)
+        self.assertEqual(
+            [(event['resource'], event['active'])
+             for event in mod.exit_json.call_args[1]['events']],
+            [('haproxy', False), ('haproxy', True)])
+        self.assertIn("4 events", mod.exit_json.call_args[1]['msg'])
+
+    @patch('modules.pacemaker_is_active.sleep')
+    @patch('modules.pacemaker_is_active.time.time')
+    @patch('modules.pacemaker_is_active.Clone.expected_count')
+    def test__watch__crm_mon_fails(self, clone_expected_count, now, sleep):
+        good = (0, MyTestUtils.cib_file_to_string(GOOD_CIB), '')
+        down = (102, '', 'Connection to cluster failed\n')
+        outputs = [good, good, down, down, good]
+        clock = [1000.0]
+        now.side_effect = lambda: clock[0]
+
+        def tick(interval):
+            clock[0] += interval
+        sleep.side_effect = tick
+
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(resource='haproxy', resources=None, watch=True,
+                          watch_duration=6, watch_interval=2)
+        mod.run_command.side_effect = lambda *args: outputs.pop(0)
+        clone_expected_count.return_value = 3
+        pacemaker_is_active.watch_resources(mod)
+        self.assertEqual(0, mod.fail_json.call_count)
+        events = mod.exit_json.call_args[1]['events']
+        self.assertEqual(
+            [(event['active'], event['current']) for event in events],
+            [(True, 3), (None, None), (True, 3)])
+        self.assertEqual(events[1]['error'], 'Connection to cluster failed')
+        self.assertEqual(outputs, [])
+
+    @patch('modules.pacemaker_is_active.watch_resources')
+    @patch('modules.pacemaker_is_active.AnsibleModule')
+    def test__watch__nothing(self, module, watch_resources):
+        module.return_value.params = dict(
+            resource=None, resources=None, snapshots=None, watch=True,
+            watch_duration=60, max_wait=5, profile='none')
+        pacemaker_is_active.main()
+        self.assertEqual(1, module.return_value.fail_json.call_count)
+        self.assertEqual(0, watch_resources.call_count)
+
+
+class TestSnapshots(unittest.TestCase):
+    def test__evaluate_snapshots(self):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(
+            resource='galera',
+            resources=['haproxy'],
+            snapshots=[GOOD_CIB, BUNDLE_CIB],
+            expected_counts={'galera': 3},
+        )
+        pacemaker_is_active.evaluate_snapshots(mod)
+        self.assertEqual(0, mod.fail_json.call_count)
+        readiness = mod.exit_json.call_args[1]['readiness']
+        self.assertEqual(readiness['snapshots'], [GOOD_CIB, BUNDLE_CIB])
+        self.assertEqual(readiness['resources'], ['galera', 'haproxy'])
+        self.assertEqual(readiness['expected'], [[3, 3], [3, 3]])
+        self.assertEqual(readiness['current'], [[3, 3], [2, 3]])
+        self.assertEqual(readiness['ready'], [[True, True], [False, True]])
+
+    def test__evaluate_snapshots__missing(self):
+        mod_cls = create_autospec(AnsibleModule)
+        mod = mod_cls.return_value
+        mod.params = dict(resource=None, resources=[],
+                          snapshots=['/nonexistent/crm_mon.xml'],
+                          expected_counts=None)
+        pacemaker_is_active.evaluate_snapshots(mod)
+        self.assertEqual(1, mod.fail_json.call_count)
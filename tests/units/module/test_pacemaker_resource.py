@@ -0,0 +1,133 @@
+from ansible.compat.tests import unittest
+from ansible.compat.tests.mock import create_autospec, patch
+from ansible.module_utils.basic import AnsibleModule
+
+from modules import pacemaker_resource
+import shutil
+import tempfile
+
+PCS_STATUS = (
+    " Master/Slave Set: galera-master [galera]\n"
+    "     galera\t(ocf::heartbeat:galera):\tMaster controller-0\n"
+    "     galera-bundle-0\t(ocf::heartbeat:galera):\tSlave controller-1\n"
+    " galera Master\n"
+    "     haproxy\t(systemd:haproxy):\tStarted controller-0\n"
+)
+
+
+def main_params(**params):
+    defaults = dict(state='master', resource='galera', timeout=10,
+                    check_mode=False, wait_for_resource=False, cache_ttl=0,
+                    cache_dir='/nonexistent', timeline=False, timeline_file=None,
+                    profile='none')
+    defaults.update(params)
+    return defaults
+
+
+class TestGrepResource(unittest.TestCase):
+    def test__grep_resource__like_grep_w(self):
+        # grep -w "galera[ \t]" rejects "galera Master", "galera\t(" is
+        # followed by a non-word character.
+        self.assertEqual(
+            pacemaker_resource.grep_resource(PCS_STATUS, 'galera'),
+            "     galera\t(ocf::heartbeat:galera):\tMaster controller-0")
+        self.assertEqual(
+            pacemaker_resource.grep_resource(PCS_STATUS, 'galera-bundle-0'),
+            "     galera-bundle-0\t(ocf::heartbeat:galera):\t"
+            "Slave controller-1")
+        self.assertEqual(
+            pacemaker_resource.grep_resource(PCS_STATUS, 'redis'), '')
+
+
+class TestCheckResourceState(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        mod_cls = create_autospec(AnsibleModule)
+        self.mod = mod_cls.return_value
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test__check_resource_state__grep(self):
+        self.mod.run_command.return_value = (
+            0, pacemaker_resource.grep_resource(PCS_STATUS, 'galera'), '')
+        self.assertTrue(pacemaker_resource.check_resource_state(
+            self.mod, 'galera', 'master'))
+        self.assertIn('grep -w "galera[ \t]"',
+                      self.mod.run_command.call_args[0][0])
+
+    def test__check_resource_state__cached(self):
+        cache = pacemaker_resource.StatusCache(self.cache_dir, 30)
+        cache.put(pacemaker_resource.PCS_STATUS_KEY, PCS_STATUS)
+        self.assertTrue(pacemaker_resource.check_resource_state(
+            self.mod, 'galera', 'master', cache))
+        self.assertEqual(0, self.mod.run_command.call_count)
+
+    def test__check_resource_state__cache_not_trusted(self):
+        # the cached status does not have the state, read the live one
+        cache = pacemaker_resource.StatusCache(self.cache_dir, 30)
+        cache.put(pacemaker_resource.PCS_STATUS_KEY,
+                  PCS_STATUS.replace('Master controller-0', 'Stopped'))
+        self.mod.run_command.return_value = (0, PCS_STATUS, '')
+        self.assertTrue(pacemaker_resource.check_resource_state(
+            self.mod, 'galera', 'master', cache))
+        self.mod.run_command.assert_called_once_with("pcs status --full")
+        self.assertEqual(cache.get(pacemaker_resource.PCS_STATUS_KEY),
+                         PCS_STATUS)
+
+
+class TestSetResourceState(unittest.TestCase):
+    def _mod(self):
+        mod_cls = create_autospec(AnsibleModule)
+        return mod_cls.return_value
+
+    def test__set_resource_state__wait(self):
+        mod = self._mod()
+        mod.run_command.return_value = (0, '', '')
+        pacemaker_resource.set_resource_state(
+            mod, 'galera', 'enable', pacemaker_resource.Deadline(42))
+        mod.run_command.assert_called_once_with(
+            "pcs resource enable galera --wait=42")
+
+    def test__set_resource_state__delete_not_done(self):
+        mod = self._mod()
+        mod.run_command.side_effect = [(0, '', ''), (0, 'config', '')]
+        rc, out, err = pacemaker_resource.set_resource_state(
+            mod, 'galera', 'delete', pacemaker_resource.Deadline(42))
+        self.assertEqual(rc, 1)
+
+
+@patch('modules.pacemaker_resource.AnsibleModule')
+class TestMain(unittest.TestCase):
+    def _main(self, module, **params):
+        module.return_value.params = main_params(**params)
+        module.return_value.exit_json.side_effect = SystemExit
+        module.return_value.fail_json.side_effect = SystemExit
+        with self.assertRaises(SystemExit):
+            pacemaker_resource.main()
+
+    def test__main__wait_timeline(self, module):
+        stopped = PCS_STATUS.replace('Master controller-0', 'Stopped')
+        module.return_value.run_command.side_effect = [
+            (0, pacemaker_resource.grep_resource(stopped, 'galera'), ''),
+            (0, pacemaker_resource.grep_resource(stopped, 'galera'), ''),
+            (0, pacemaker_resource.grep_resource(PCS_STATUS, 'galera'), ''),
+        ]
+        self._main(module, check_mode=True, wait_for_resource=True,
+                   timeline=True)
+        self.assertEqual(0, module.return_value.fail_json.call_count)
+        result = module.return_value.exit_json.call_args[1]
+        self.assertEqual(result['timeline']['current'],
+                         [False, False, True])
+        self.assertEqual(result['commands'],
+                         {'commands': 3, 'saved_round_trips': 0})
+
+    def test__main__deadline(self, module):
+        module.return_value.run_command.return_value = (0, '', '')
+        self._main(module, state='enable', timeout=60)
+        cmd = module.return_value.run_command.call_args[0][0]
+        # pcs only waits for what is left of the timeout
+        self.assertTrue(cmd.startswith("timeout -k 5 "))
+        wait = int(cmd.split('--wait=')[1])
+        self.assertTrue(0 < wait <= 60)
+        self.assertTrue(module.return_value.exit_json.call_args[1]['changed'])
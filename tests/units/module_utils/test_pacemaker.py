@@ -0,0 +1,129 @@
+from ansible.compat.tests import unittest
+from ansible.compat.tests.mock import create_autospec, patch
+from ansible.module_utils.basic import AnsibleModule
+
+from ansible.module_utils import pacemaker
+from modules import pacemaker_is_active
+import os
+import shutil
+import tempfile
+
+BUNDLE_CIB = "./tests/units/module/corpus/cluster_bundle.xml"
+
+
+class TestStatusCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test__status_cache__roundtrip(self):
+        cache = pacemaker.StatusCache(self.cache_dir, 5)
+        self.assertIsNone(cache.get('crm_mon'))
+        cache.put('crm_mon', '<crm_mon/>')
+        self.assertEqual(cache.get('crm_mon'), '<crm_mon/>')
+        cache.clear()
+        self.assertIsNone(cache.get('crm_mon'))
+
+    def test__status_cache__clear_shared_dir(self):
+        other = os.path.join(self.cache_dir, 'inventory.json')
+        with open(other, 'w') as other_file:
+            other_file.write('{}')
+        cache = pacemaker.StatusCache(self.cache_dir, 5)
+        cache.put('cluster_status', 'online')
+        cache.clear()
+        self.assertEqual(os.listdir(self.cache_dir), ['inventory.json'])
+
+    @patch('ansible.module_utils.pacemaker.time.time')
+    def test__status_cache__expired(self, now):
+        cache = pacemaker.StatusCache(self.cache_dir, 2)
+        now.return_value = 100.0
+        cache.put('crm_mon', '<crm_mon/>')
+        now.return_value = 101.5
+        self.assertEqual(cache.get('crm_mon'), '<crm_mon/>')
+        now.return_value = 102.0
+        self.assertIsNone(cache.get('crm_mon'))
+
+    def test__status_cache__fetch(self):
+        cache = pacemaker.StatusCache(self.cache_dir, 5)
+        reads = []
+
+        def read():
+            reads.append(1)
+            return 'online'
+        self.assertEqual(cache.fetch('cluster_status', read), 'online')
+        self.assertEqual(cache.fetch('cluster_status', read), 'online')
+        self.assertEqual(len(reads), 1)
+        # an untrusted value is read again
+        cache.fetch('cluster_status', read, lambda cached: False)
+        self.assertEqual(len(reads), 2)
+
+    def test__status_cache__fetch_disabled(self):
+        cache = pacemaker.StatusCache(self.cache_dir, 0)
+        self.assertEqual(cache.fetch('cluster_status', lambda: 'online'),
+                         'online')
+        self.assertIsNone(pacemaker.StatusCache(self.cache_dir, 5)
+                          .get('cluster_status'))
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.clock = [0.0]
+        patcher = patch('ansible.module_utils.pacemaker.process_start',
+                        return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _now(self):
+        return self.clock[0], self.clock[0] / 2
+
+    def test__profiler__disabled(self):
+        profiler = pacemaker.Profiler()
+        with profiler.phase('commands'):
+            pass
+        self.assertFalse(profiler.enabled)
+        self.assertEqual(profiler.phases, {})
+
+    def test__profiler__nested_phases(self):
+        profiler = pacemaker.Profiler()
+        with patch.object(profiler, 'now', side_effect=self._now):
+            self.clock[0] = 1.0
+            profiler.start('phases', (0.0, 0.0))
+            self.clock[0] = 2.0
+            with profiler.phase('commands'):
+                self.clock[0] = 5.0
+            self.clock[0] = 6.0
+            report = profiler.report()
+        self.assertEqual(report['total'], {'wall': 6.0, 'cpu': 3.0})
+        self.assertEqual(report['phases'], {
+            'arguments': {'calls': 1, 'wall': 1.0, 'cpu': 0.5},
+            'commands': {'calls': 1, 'wall': 3.0, 'cpu': 1.5},
+            'main': {'calls': 1, 'wall': 2.0, 'cpu': 1.0},
+        })
+        self.assertNotIn('hotspots', report)
+
+    def test__profiler__module_result(self):
+        profiler = pacemaker.Profiler()
+        mod_cls = create_autospec(AnsibleModule)
+        mod = pacemaker.CommandRunner(mod_cls.return_value)
+        mod.module.run_command.return_value = (0, '', '')
+        with patch('ansible.module_utils.pacemaker.PROFILER', profiler), \
+                patch('modules.pacemaker_is_active.PROFILER', profiler):
+            mod.exit_json(changed=False)
+            self.assertNotIn('profile', mod.module.exit_json.call_args[1])
+            profiler.start('full')
+            pacemaker_is_active._LAST_STATUS.clear()
+            mod.run_command(['crm_mon', '-r', '--as-xml'])
+            with open(BUNDLE_CIB) as cib:
+                pacemaker_is_active.parse_status(cib.read())
+            mod.exit_json(changed=False)
+        if pacemaker.tracemalloc is not None:
+            pacemaker.tracemalloc.stop()
+        report = mod.module.exit_json.call_args[1]['profile']
+        self.assertEqual(report['mode'], 'full')
+        self.assertEqual(report['phases']['commands']['calls'], 1)
+        self.assertEqual(report['phases']['parse']['calls'], 1)
+        self.assertTrue(report['hotspots'])
+        if pacemaker.tracemalloc is not None:
+            self.assertIn('peak_kb', report['phases']['parse'])